@@ -0,0 +1,88 @@
+'''
+Measures what running games in engine processes costs (server.py --engines).
+A move goes gateway -> engine and its update comes back engine -> gateway,
+compared with the same work done in a single process
+'''
+import sys
+import time
+import argparse
+import multiprocessing
+import tiles
+
+
+def turn_update(packed, idnums):
+    '''
+    The work an engine does for one move, minus the game itself: decode it
+    and build the frame every player is sent
+    '''
+    msg, _ = tiles.read_message_from_bytearray(bytearray(packed))
+    frame = msg.pack() + tiles.MessagePlayerTurn(msg.idnum).pack()
+    return [(frame, False, idnums)]
+
+
+def echo_engine(connection):
+    '''
+    An engine process that answers every move straight away
+    '''
+    while True:
+        try:
+            _, idnum, packed, idnums = connection.recv()
+        except EOFError:
+            return
+
+        frames = []
+        for chunk in packed:
+            frames.extend(turn_update(chunk, idnums))
+        connection.send(frames)
+
+
+def bench_local(moves, players, batch):
+    packed = [tiles.MessagePlaceTile(0, 1, 2, 3, 4).pack()] * batch
+    idnums = list(range(players))
+
+    start = time.perf_counter()
+    for _ in range(moves // batch):
+        for chunk in packed:
+            turn_update(chunk, idnums)
+    return time.perf_counter() - start
+
+
+def bench_pipe(moves, players, batch):
+    context = multiprocessing.get_context('spawn')
+    connection, remote = context.Pipe()
+    process = context.Process(target=echo_engine, args=(remote,), daemon=True)
+    process.start()
+    remote.close()
+
+    packed = [tiles.MessagePlaceTile(0, 1, 2, 3, 4).pack()] * batch
+    idnums = list(range(players))
+
+    # warm up the engine before timing it
+    connection.send(('input', 0, packed, idnums))
+    connection.recv()
+
+    start = time.perf_counter()
+    for _ in range(moves // batch):
+        connection.send(('input', 0, packed, idnums))
+        connection.recv()
+    elapsed = time.perf_counter() - start
+
+    connection.close()
+    process.join()
+    return elapsed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--moves', type=int, default=20000)
+    parser.add_argument('--players', type=int, default=4,
+                        help='idnums each update is addressed to')
+    args = parser.parse_args()
+
+    print('{:>6} {:>14} {:>14} {:>10}'.format('batch', 'local us/move', 'pipe us/move', 'overhead'))
+    for batch in (1, 8, 64):
+        local = bench_local(args.moves, args.players, batch)
+        pipe = bench_pipe(args.moves, args.players, batch)
+        print('{:>6} {:>14.2f} {:>14.2f} {:>9.1f}x'.format(
+            batch, local / args.moves * 1e6, pipe / args.moves * 1e6, pipe / local))
+        sys.stdout.flush()
@@ -0,0 +1,64 @@
+'''
+Prints the boards a server started with --shared-board publishes, read
+straight from shared memory without connecting to the server
+'''
+import time
+import argparse
+from multiprocessing import shared_memory, resource_tracker
+import tiles
+from server import BOARD_SLOT, read_board
+
+
+def attach(name):
+    try:
+        return shared_memory.SharedMemory(name, track=False)
+    except TypeError:
+        # before python 3.13 a reader exiting would remove the block
+        memory = shared_memory.SharedMemory(name)
+        resource_tracker.unregister(memory._name, 'shared_memory')
+        return memory
+
+
+def describe(number, state):
+    lines = ['room {} version {}'.format(number, state['version'])]
+
+    seats = []
+    for idnum in state['seats']:
+        mark = ''
+        if idnum == state['current']:
+            mark = '*'
+        elif idnum in state['eliminated']:
+            mark = 'x'
+        seats.append('{}{}{}'.format(idnum, mark, state['positions'].get(idnum, '')))
+    lines.append('  seats: ' + (' '.join(seats) or '-'))
+
+    # tile id and rotation square by square, row 0 at the top
+    for y in range(tiles.BOARD_HEIGHT):
+        row = []
+        for x in range(tiles.BOARD_WIDTH):
+            index = y * tiles.BOARD_WIDTH + x
+            tileid = state['tileids'][index]
+            row.append('  .  ' if tileid is None else '{:>3}:{}'.format(tileid, state['tilerotations'][index]))
+        lines.append('  ' + ' '.join(row))
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Tiles shared board reader')
+    parser.add_argument('name', help='the --shared-board name the server was started with')
+    parser.add_argument('--room', type=int, help='only this room (default every room)')
+    parser.add_argument('--interval', type=float, default=1.0,
+                        help='seconds between reads (default 1)')
+    parser.add_argument('--once', action='store_true', help='read once and exit')
+    args = parser.parse_args()
+
+    memory = attach(args.name)
+    rooms = memory.size // BOARD_SLOT
+    numbers = range(rooms) if args.room is None else [args.room]
+
+    while True:
+        for number in numbers:
+            print(describe(number, read_board(memory.buf, number)))
+        if args.once:
+            break
+        time.sleep(args.interval)
@@ -0,0 +1,178 @@
+'''
+Messages the server understands beyond the ones tiles.py defines. tiles.py
+cannot change, so these live here with type numbers well clear of its own.
+A stock client never sends them and so never receives any
+'''
+import struct
+from enum import IntEnum
+import tiles
+
+
+class MessageType(IntEnum):
+    RESUME = 100
+    SESSION = 101
+    WATCH = 102
+    SUBSCRIBE = 103
+
+
+# every type a message can have
+KNOWN_TYPES = frozenset(tiles.MessageType) | frozenset(MessageType)
+
+
+class MessageResume():
+    '''
+    Sent by a client as its first message to take part in sessions. A zero
+    token asks for a new session, any other token asks for the seat held for
+    it back, offset being how many bytes of the session were processed
+    '''
+    def __init__(self, token: int, offset: int):
+        self.token = token
+        self.offset = offset
+
+    def pack(self):
+        return struct.pack('!HQQ', MessageType.RESUME, self.token, self.offset)
+
+    @classmethod
+    def unpack(cls, bs: bytearray):
+        messagelen = struct.calcsize('!HQQ')
+
+        if len(bs) >= messagelen:
+            _, token, offset = struct.unpack_from('!HQQ', bs, 0)
+            return cls(token, offset), messagelen
+
+        return None, 0
+
+
+class MessageSession():
+    '''
+    Sent by the server to a client in a session. The bytes after it are
+    counted from offset, and the count is handed back on resume
+    '''
+    def __init__(self, token: int, offset: int):
+        self.token = token
+        self.offset = offset
+
+    def pack(self):
+        return struct.pack('!HQQ', MessageType.SESSION, self.token, self.offset)
+
+    @classmethod
+    def unpack(cls, bs: bytearray):
+        messagelen = struct.calcsize('!HQQ')
+
+        if len(bs) >= messagelen:
+            _, token, offset = struct.unpack_from('!HQQ', bs, 0)
+            return cls(token, offset), messagelen
+
+        return None, 0
+
+
+class MessageWatch():
+    '''
+    Sent by a waiting client to follow the game in another room. It is sent
+    that room's game so far, so should clear its board first
+    '''
+    def __init__(self, room: int):
+        self.room = room
+
+    def pack(self):
+        return struct.pack('!HH', MessageType.WATCH, self.room)
+
+    @classmethod
+    def unpack(cls, bs: bytearray):
+        messagelen = struct.calcsize('!HH')
+
+        if len(bs) >= messagelen:
+            _, room = struct.unpack_from('!HH', bs, 0)
+            return cls(room), messagelen
+
+        return None, 0
+
+
+class MessageSubscribe():
+    '''
+    Sent by a relay as its first message, with the key the server was
+    started with. It is sent everything a spectator is, but is never seated
+    or announced to anyone
+    '''
+    def __init__(self, key: int):
+        self.key = key
+
+    def pack(self):
+        return struct.pack('!HQ', MessageType.SUBSCRIBE, self.key)
+
+    @classmethod
+    def unpack(cls, bs: bytearray):
+        messagelen = struct.calcsize('!HQ')
+
+        if len(bs) >= messagelen:
+            _, key = struct.unpack_from('!HQ', bs, 0)
+            return cls(key), messagelen
+
+        return None, 0
+
+
+class Datagram():
+    '''
+    The header of a datagram in the multicast feed. Sequence numbers run
+    across the whole feed. The payloads of a keyframe, in order, are the
+    whole state. Any other payload is a piece of the stream, whole messages
+    once joined in order
+    '''
+    KEYFRAME = 1
+    FIRST = 2
+    LAST = 4
+
+    def __init__(self, sequence: int, flags: int):
+        self.sequence = sequence
+        self.flags = flags
+
+    def pack(self):
+        return struct.pack('!QB', self.sequence, self.flags)
+
+    @classmethod
+    def unpack(cls, bs: bytearray):
+        headerlen = struct.calcsize('!QB')
+
+        if len(bs) >= headerlen:
+            sequence, flags = struct.unpack_from('!QB', bs, 0)
+            return cls(sequence, flags), headerlen
+
+        return None, 0
+
+
+def read_message_from_bytearray(bs: bytearray):
+    '''
+    Same as tiles.read_message_from_bytearray, also reading the messages
+    defined here
+    '''
+    msg, consumed = tiles.read_message_from_bytearray(bs)
+    if consumed or len(bs) < struct.calcsize('!H'):
+        return msg, consumed
+
+    typeint, = struct.unpack_from('!H', bs, 0)
+
+    if typeint == MessageType.RESUME:
+        return MessageResume.unpack(bs)
+
+    elif typeint == MessageType.SESSION:
+        return MessageSession.unpack(bs)
+
+    elif typeint == MessageType.WATCH:
+        return MessageWatch.unpack(bs)
+
+    elif typeint == MessageType.SUBSCRIBE:
+        return MessageSubscribe.unpack(bs)
+
+    return None, 0
+
+
+def known_type(bs: bytearray):
+    '''
+    False if bs starts with a message type defined neither here nor in
+    tiles.py, leaving no way to tell where the next message starts
+    '''
+    if len(bs) < struct.calcsize('!H'):
+        return True
+
+    typeint, = struct.unpack_from('!H', bs, 0)
+    return typeint in KNOWN_TYPES
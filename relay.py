@@ -0,0 +1,251 @@
+'''
+Re-serves a server's spectator stream to any number of stock clients. The
+relay subscribes to the server once (see --relay-key in server.py) and
+every client connected here is a spectator of that one stream. Relays can
+subscribe to other relays, so spectators can be spread over a tree of them.
+A relay can also take the stream from the server's multicast feed
+'''
+import socket
+import argparse
+import tiles
+import extensions
+from server import (Player, Registry, Roster, Snapshot, SendLimits, catch_up,
+                    PORT, RECV_SIZE, BACKLOG,
+                    SPECTATOR_INTERVAL, SPECTATOR_PRESSURE, SEND_LIMIT, SLOW_TIMEOUT)
+
+
+class Feed():
+    '''
+    The stream from upstream, with the roster and game so far kept the way
+    the server keeps them, so a spectator arriving late is caught up just
+    as the server would
+    '''
+    def __init__(self, connection):
+        self.connection = connection
+        self.idnum = None
+        self.buffer = bytearray()
+        self.roster = Roster()
+        self.snapshot = Snapshot()
+
+    def feed(self, data):
+        '''
+        Take in received bytes, returning the complete messages among them
+        as they should be passed on
+        '''
+        self.buffer.extend(data)
+        forward = []
+        offset = 0
+
+        with memoryview(self.buffer) as view:
+            while True:
+                msg, consumed = tiles.read_message_from_bytearray(view[offset:])
+                if not consumed:
+                    break
+                packed = bytes(view[offset:offset + consumed])
+                offset += consumed
+
+                # the welcome is ours, everyone here gets their own copy
+                if isinstance(msg, tiles.MessageWelcome):
+                    self.idnum = msg.idnum
+                    continue
+
+                if isinstance(msg, tiles.MessagePlayerJoined):
+                    self.roster.add(msg, packed)
+                elif isinstance(msg, tiles.MessagePlayerLeft):
+                    self.roster.remove(msg.idnum)
+                    self.snapshot.depart(msg.idnum)
+                else:
+                    self.snapshot.extend([(msg, packed)])
+                forward.append(packed)
+
+        del self.buffer[:offset]
+        return b''.join(forward)
+
+    def receive(self, view):
+        '''
+        Read what upstream sent, returning the bytes to pass on, or None once
+        upstream has gone
+        '''
+        try:
+            received = self.connection.recv_into(view)
+        except (BlockingIOError, InterruptedError):
+            return b''
+        except ConnectionError:
+            received = 0
+
+        if not received:
+            return None
+        return self.feed(view[:received])
+
+
+class MulticastFeed(Feed):
+    '''
+    The stream put back together from the multicast feed. Datagrams are
+    taken in order from the first whole keyframe on. After a loss nothing
+    is passed on until the next keyframe, which spectators here are then
+    brought up to date with
+    '''
+    def __init__(self, connection):
+        super().__init__(connection)
+        self.synced = False
+        self.expected = None
+        self.keyframe = None
+        self.next = None
+
+    def receive(self, view):
+        try:
+            received = self.connection.recv_into(view)
+        except (BlockingIOError, InterruptedError):
+            return b''
+
+        header, headerlen = extensions.Datagram.unpack(view[:received])
+        if header is None:
+            return b''
+        payload = view[headerlen:received]
+
+        if self.synced:
+            if header.sequence == self.expected:
+                self.expected += 1
+                if header.flags & extensions.Datagram.KEYFRAME:
+                    return b''
+                return self.feed(payload)
+
+            # a datagram went missing, wait for the next keyframe
+            self.synced = False
+
+        # collect a keyframe from its first datagram to its last
+        if not header.flags & extensions.Datagram.KEYFRAME:
+            return b''
+        if header.flags & extensions.Datagram.FIRST:
+            self.keyframe = []
+        elif self.keyframe is None or header.sequence != self.next:
+            self.keyframe = None
+            return b''
+        self.keyframe.append(bytes(payload))
+        self.next = header.sequence + 1
+
+        if header.flags & extensions.Datagram.LAST:
+            return self.resync(header.sequence)
+        return b''
+
+    def resync(self, sequence):
+        '''
+        Take the collected keyframe as the state, returning what spectators
+        here need to go from the old state to it
+        '''
+        state = Feed(None)
+        state.feed(b''.join(self.keyframe))
+        self.keyframe = None
+        self.synced = True
+        self.expected = sequence + 1
+
+        parts = []
+        for idnum in self.roster.where:
+            if idnum not in state.roster.where:
+                parts.append(tiles.MessagePlayerLeft(idnum).pack())
+        for idnum, chunk in state.roster.where.items():
+            if idnum not in self.roster.where:
+                parts.append(chunk.joined[idnum])
+        parts.append(state.snapshot.packed())
+
+        self.idnum = state.idnum
+        self.buffer = state.buffer
+        self.roster = state.roster
+        self.snapshot = state.snapshot
+        return b''.join(parts)
+
+
+def relay(args):
+    if args.multicast:
+        group, _, port = args.multicast.rpartition(':')
+        upstream = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        upstream.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        upstream.bind(('', int(port)))
+        upstream.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP,
+                            socket.inet_aton(group) + socket.inet_aton(args.interface))
+        feed = MulticastFeed(upstream)
+    else:
+        host, _, port = args.upstream.rpartition(':')
+        upstream = socket.create_connection((host or 'localhost', int(port)))
+        upstream.sendall(extensions.MessageSubscribe(args.key).pack())
+        if args.room:
+            upstream.sendall(extensions.MessageWatch(args.room).pack())
+        feed = Feed(upstream)
+
+    # one receive buffer reused for every read
+    chunk = bytearray(RECV_SIZE)
+    view = memoryview(chunk)
+
+    # nobody can be caught up before the welcome arrives
+    while feed.idnum is None:
+        if feed.receive(view) is None:
+            return
+    upstream.setblocking(False)
+
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.bind(('', args.port))
+    server.listen(args.backlog)
+    server.setblocking(False)
+
+    # the stream is passed on whole, so a slow spectator can only be dropped
+    limits = SendLimits(args.send_limit, 'disconnect', args.slow_timeout)
+    registry = Registry(server, args.spectator_interval, args.spectator_pressure, limits)
+
+    # spectators by file descriptor, they all share one idnum
+    spectators = {}
+
+    def drop(client):
+        del spectators[client.connection.fileno()]
+        registry.remove(client)
+        client.close()
+
+    def forward():
+        # without the server there is nothing left to relay
+        data = feed.receive(view)
+        if data is None:
+            return True
+        if data:
+            for spectator in spectators.values():
+                spectator.send(data, deferred=True)
+
+    def accept(connection, client_address):
+        # every spectator here shares the relay's idnum
+        newPlayer = Player(connection, client_address, feed.idnum)
+        registry.add(newPlayer)
+        newPlayer.send_all(catch_up(newPlayer, feed.roster, feed.snapshot))
+        spectators[connection.fileno()] = newPlayer
+
+    def receive(client, data, now):
+        # spectators have nothing to say, only hanging up matters
+        pass
+
+    registry.add_service(upstream, forward)
+    registry.serve(accept, receive, drop)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Tiles spectator relay')
+    parser.add_argument('--upstream', default='localhost:{}'.format(PORT),
+                        help='server or relay to subscribe to (default localhost:{})'.format(PORT))
+    parser.add_argument('--key', type=int, default=0,
+                        help='the --relay-key the server was started with')
+    parser.add_argument('--multicast', metavar='GROUP:PORT',
+                        help='take the stream from the server\'s multicast feed instead of subscribing')
+    parser.add_argument('--interface', default='0.0.0.0',
+                        help='address of the interface the multicast feed arrives on (default any)')
+    parser.add_argument('--room', type=int, default=0,
+                        help='room whose game is relayed (default 0)')
+    parser.add_argument('--port', type=int, default=PORT,
+                        help='port spectators connect to (default {})'.format(PORT))
+    parser.add_argument('--backlog', type=int, default=BACKLOG,
+                        help='connections the OS queues before they are accepted (default {})'.format(BACKLOG))
+    parser.add_argument('--spectator-interval', type=float, default=SPECTATOR_INTERVAL,
+                        help='seconds between spectator updates when the relay is under pressure')
+    parser.add_argument('--spectator-pressure', type=int, default=SPECTATOR_PRESSURE,
+                        help='spectators waiting on output before their updates are coalesced')
+    parser.add_argument('--send-limit', type=int, default=SEND_LIMIT,
+                        help='bytes waiting for a spectator before it counts as slow (default {})'.format(SEND_LIMIT))
+    parser.add_argument('--slow-timeout', type=float, default=SLOW_TIMEOUT,
+                        help='seconds a spectator may stay over the send limit before it is dropped '
+                             '(default {})'.format(SLOW_TIMEOUT))
+    relay(parser.parse_args())
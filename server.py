@@ -5,20 +5,93 @@ Developed in Windows
 import socket
 import sys
 import tiles
-from threading import Thread
+import extensions
+from threading import Thread, Condition, Lock, RLock, get_ident
+from queue import SimpleQueue
 import random
 import time
-import select
+import selectors
+import asyncio
+import argparse
+from collections import deque
+from itertools import islice, count
+import heapq
+import secrets
+import os
+import signal
+import atexit
+import tempfile
+import multiprocessing
+import struct
+from multiprocessing import shared_memory
+from multiprocessing.connection import Listener, Client, wait
+from multiprocessing.reduction import send_handle, recv_handle
 
 TIMEOUT = 10 # maximum before random move occurs (seconds)
+PORT = 30020 # default listening port
+RECV_SIZE = 4096 # bytes read from a socket at once
+MAX_IOVECS = 1024 # buffers handed to a single vectored write
+SPECTATOR_INTERVAL = 0.5 # seconds between spectator flushes under pressure
+SPECTATOR_PRESSURE = 256 # spectators waiting on output that count as pressure
+SPECTATOR_BATCH = 64 # spectators flushed before players are serviced again
+SEND_LIMIT = 1 << 20 # bytes waiting for a client before it counts as slow
+SLOW_TIMEOUT = 30 # seconds a client may stay over the send limit before it is dropped
+SLOW_POLICY = 'skip' # what a slow spectator is sent, see SendLimits
+PLAYER_INPUT = (2048, 16) # bytes and messages a second a player in a game may send
+SPECTATOR_INPUT = (64, 1) # bytes and messages a second anyone else may send
+INPUT_BURST = 4 # seconds of input allowance a connection can save up
+FLOOD_POLICY = 'throttle' # what happens to a connection sending too much, see InputLimits
+ACCEPT_BATCH = 128 # connections accepted per wakeup before reads are serviced
+BACKLOG = socket.SOMAXCONN # default length of the listen queue
+ROSTER_CHUNK = 256 # players per pre-packed piece of the roster
+ROSTER_WINDOW = 0.05 # seconds roster changes are collected before announcing them
+LONELY_CHECK = 1.0 # seconds between a worker's reports of a player waiting alone
+HANDOVER_TIMEOUT = 1.0 # seconds a worker may block writing out a player it hands over
+HELLO_WINDOW = 0.25 # seconds a new connection has to ask for its session back
+HISTORY_LIMIT = 1 << 18 # bytes of output kept for a client resuming its session
+MULTICAST_PAYLOAD = 1200 # bytes of the stream carried by one multicast datagram
+KEYFRAME_INTERVAL = 1.0 # seconds between full states sent to the multicast group
+MATCH_TIEBREAK = 'random' # order of players who started waiting together, see Matchmaker
+WAIT_SAMPLES = 4096 # recent waits kept for the wait percentiles
+
+# a room's board in shared memory: a version, then whose turn it is, the
+# seats as (idnum, eliminated, x, y, position) and the tile ids, rotations
+# and placer ids square by square. -1 stands in for nothing
+BOARD_SQUARES = tiles.BOARD_WIDTH * tiles.BOARD_HEIGHT
+BOARD_VERSION = struct.Struct('=Q')
+BOARD_STATE = struct.Struct('=iB' + 'iBbbb' * tiles.PLAYER_LIMIT + '{0}h{0}b{0}i'.format(BOARD_SQUARES))
+BOARD_SLOT = (BOARD_VERSION.size + BOARD_STATE.size + 63) // 64 * 64
+
+# guards lobby, queue and the snapshot between the I/O, onboarding and game threads
+gameLock = RLock()
 
 class Player():
-    def __init__(self, connection, address, idnum):
+    def __init__(self, connection, address, idnum, generation=0):
         self.connection = connection
         self.host, self.port = address
         self.idnum = idnum
-        self.message = None
+        self.generation = generation
+        self.buffer = bytearray()
+        self.outbox = deque()
+        self.registry = None
+        self.closed = False
+        self.writePending = False
         self.hand = []
+        self.welcomed = False
+        self.session = None
+        self.detached = False
+        self.room = None
+        self.seated = False
+        self.watching = None
+        self.relay = False
+        self.limits = None
+        self.queued = 0
+        self.overSince = None
+        self.sendLock = Lock()
+        self.shedding = False
+        self.bytesIn = TokenBucket()
+        self.messagesIn = TokenBucket()
+        self.throttled = 0
 
     def __eq__(self, other):
         return self.idnum == other.idnum
@@ -26,68 +99,628 @@ class Player():
     def getName(self):
         return '{}:{}'.format(self.host, self.port)
 
-
-def boradcastCurrentPlayer(clients, currentPlayer):
-    global updateStack
-    msg = tiles.MessagePlayerTurn(currentPlayer.idnum).pack()
-    updateStack.append(msg)
-    for client in clients:
-        client.message = None
-        client.connection.send(msg)
-
-
-def boradcastPlayerEliminated(clients, player):
-    global updateStack
-    msg = tiles.MessagePlayerEliminated(player.idnum).pack()
-    updateStack.append(msg)
-
-    for client in clients:
-        client.connection.send(msg)
-
-
-def boradcastPlayerLeave(clients, player):
-    for client in clients:
-        msg = tiles.MessagePlayerLeft(player.idnum).pack()
-        client.connection.send(msg)
-
-
-def boradcastGameStart(clients):
-    global updateStack
-    msg = tiles.MessageGameStart().pack()
-    updateStack.append(msg)
-
-    for client in clients:
-        client.connection.send(msg)
-
-
-def boradcastPositionUpdates(clients, updates):
-    global updateStack
-
+    def seat(self, seated):
+        # whether the player has a seat in its room's lobby
+        self.seated = seated
+
+    def send(self, data, deferred=False):
+        # a detached player catches up from its session when it returns
+        if self.session is not None:
+            self.session.record(data)
+        if self.detached:
+            return
+
+        # never touch the socket here, the I/O loop writes it out
+        self.enqueue((data,))
+        if self.registry is not None:
+            self.registry.want_write(self, deferred)
+
+    def send_all(self, parts, deferred=False, record=True):
+        # the pieces go out together in one vectored write
+        if record and self.session is not None:
+            for data in parts:
+                self.session.record(data)
+        if self.detached:
+            return
+        self.enqueue(parts)
+        if self.registry is not None:
+            self.registry.want_write(self, deferred)
+
+    def enqueue(self, parts):
+        # the I/O thread counts bytes off as it writes them, so the count
+        # and when it went over the limit only change under sendLock
+        with self.sendLock:
+            self.outbox.extend(parts)
+            self.queued += sum(len(data) for data in parts)
+            self.watch_backlog()
+
+    def send_update(self, data, snapshot):
+        '''
+        A game update for a spectator, which a slow one may go without. See
+        SendLimits for what it is sent instead
+        '''
+        limits = self.limits
+        if limits is None or limits.policy == 'disconnect':
+            self.send(data, deferred=True)
+        elif self.shedding:
+            if self.backlog():
+                limits.skipped += 1
+                return
+
+            # caught up, so the game as it stands replaces what was missed
+            limits.snapshots += 1
+            self.shedding = limits.policy == 'snapshot'
+            self.send(snapshot.packed(), deferred=True)
+        elif self.backlog() >= limits.limit:
+            limits.skipped += 1
+            self.shedding = True
+        else:
+            self.send(data, deferred=True)
+
+    def backlog(self):
+        return self.queued
+
+    def watch_backlog(self):
+        # note when the backlog goes over the limit, the registry drops the
+        # client if it is still over once the limit's timeout has passed
+        limits = self.limits
+        if limits is None or self.overSince is not None or self.backlog() < limits.limit:
+            return
+        self.overSince = time.monotonic()
+        if self.registry is not None:
+            self.registry.over_limit(self)
+
+    def close(self):
+        self.closed = True
+        self.connection.close()
+
+    def detach(self):
+        '''
+        Drop the connection but keep the seat, output only goes to the
+        session until a new connection is attached
+        '''
+        self.detached = True
+        with self.sendLock:
+            self.outbox.clear()
+            self.queued = 0
+            self.overSince = None
+        self.buffer.clear()
+        self.connection.close()
+
+    def flush(self):
+        '''
+        Write as much of the outbox as the socket accepts without blocking.
+        Returns True once the outbox is empty
+        '''
+        outbox = self.outbox
+        while outbox:
+            buffers = list(islice(outbox, MAX_IOVECS))
+            try:
+                if hasattr(self.connection, 'sendmsg'):
+                    sent = self.connection.sendmsg(buffers)
+                else:
+                    sent = self.connection.send(b''.join(buffers))
+            except (BlockingIOError, InterruptedError):
+                return False
+
+            with self.sendLock:
+                self.queued -= sent
+                if self.overSince is not None and self.queued < self.limits.limit:
+                    self.overSince = None
+
+            # drop whatever was written, keeping the tail of a short write
+            for buffer in buffers:
+                if len(buffer) > sent:
+                    outbox[0] = memoryview(buffer)[sent:]
+                    return False
+                sent -= len(buffer)
+                outbox.popleft()
+        return True
+
+    def feed(self, data):
+        '''
+        Append received bytes and decode every complete message, partial
+        frames stay buffered until the rest arrives
+        '''
+        self.buffer.extend(data)
+        decoded = []
+        offset = 0
+
+        with memoryview(self.buffer) as view:
+            while True:
+                msg, consumed = extensions.read_message_from_bytearray(view[offset:])
+                if not consumed:
+                    break
+                decoded.append(msg)
+                offset += consumed
+
+            # after a type nobody knows the rest cannot be framed, so it goes
+            if not extensions.known_type(view[offset:]):
+                offset = len(self.buffer)
+
+        del self.buffer[:offset]
+        return decoded
+
+
+class StreamPlayer(Player):
+    '''
+    Player served by the asyncio engine, the connection is the StreamWriter
+    half of the client stream
+    '''
+    def __init__(self, writer, idnum, generation=0):
+        super().__init__(writer, writer.get_extra_info('peername')[:2], idnum, generation)
+
+    def send(self, data, deferred=False):
+        self.connection.write(data)
+        self.watch_backlog()
+
+    def send_all(self, parts, deferred=False, record=True):
+        self.connection.writelines(parts)
+        self.watch_backlog()
+
+    def backlog(self):
+        return self.connection.transport.get_write_buffer_size()
+
+    def watch_backlog(self):
+        # there is no registry here, so a slow client is dropped on the
+        # first write after its timeout
+        limits = self.limits
+        if limits is None:
+            return
+        if self.backlog() < limits.limit:
+            self.overSince = None
+        elif self.overSince is None:
+            self.overSince = time.monotonic()
+        elif time.monotonic() - self.overSince >= limits.timeout and not self.connection.is_closing():
+            limits.disconnected += 1
+            self.connection.transport.abort()
+
+    def close(self):
+        self.closed = True
+        self.connection.close()
+
+
+class MulticastPlayer(Player):
+    '''
+    Spectator output sent once to a multicast group as numbered datagrams,
+    however many are listening. Every so often a keyframe of the whole state
+    goes out too, for receivers joining late or missing datagrams
+    '''
+    def __init__(self, group, idnum, generation=0, interface='0.0.0.0'):
+        connection = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        connection.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF, socket.inet_aton(interface))
+        connection.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, 1)
+        super().__init__(connection, group, idnum, generation)
+        self.group = group
+        self.sequence = count()
+        self.relay = True
+        self.welcomed = True
+
+    def send(self, data, deferred=False):
+        self.send_datagrams(data, 0)
+
+    def send_all(self, parts, deferred=False, record=True):
+        self.send_datagrams(b''.join(parts), 0)
+
+    def keyframe(self, parts):
+        self.send_datagrams(b''.join(parts), extensions.Datagram.KEYFRAME)
+
+    def send_datagrams(self, data, flags):
+        with memoryview(data) as view:
+            for start in range(0, len(data), MULTICAST_PAYLOAD):
+                pieceFlags = flags
+                if flags & extensions.Datagram.KEYFRAME:
+                    if start == 0:
+                        pieceFlags |= extensions.Datagram.FIRST
+                    if start + MULTICAST_PAYLOAD >= len(data):
+                        pieceFlags |= extensions.Datagram.LAST
+
+                header = extensions.Datagram(next(self.sequence), pieceFlags).pack()
+                try:
+                    self.connection.sendmsg([header, view[start:start + MULTICAST_PAYLOAD]], [], 0, self.group)
+                except OSError:
+                    # a lost datagram, receivers recover at the next keyframe
+                    pass
+
+
+class TokenBucket():
+    '''
+    Credit refilled at a rate up to a burst, starting full. A connection's
+    rate changes as it is seated and leaves, so rates are passed on each use
+    '''
+    __slots__ = ('tokens', 'stamp')
+
+    def __init__(self):
+        self.tokens = None
+        self.stamp = 0
+
+    def refill(self, rate, burst, now):
+        if self.tokens is None:
+            self.tokens = burst
+        else:
+            self.tokens = min(burst, self.tokens + (now - self.stamp) * rate)
+        self.stamp = now
+
+    def take(self, amount, rate, burst, now):
+        # all of amount or nothing
+        self.refill(rate, burst, now)
+        if self.tokens < amount:
+            return False
+        self.tokens -= amount
+        return True
+
+    def spend(self, amount, rate, burst, now):
+        # spent whatever is left, returning the seconds until back in credit
+        self.refill(rate, burst, now)
+        self.tokens -= amount
+        return max(0, -self.tokens / rate)
+
+
+class InputLimits():
+    '''
+    What a connection may send each second, in bytes and in messages.
+    Players in a game get enough for normal play, everyone else next to
+    nothing. Messages past the allowance are dropped. A connection past its
+    bytes is throttled, its socket left unread until it is back in credit,
+    or with the disconnect policy dropped
+    '''
+    POLICIES = ('throttle', 'disconnect')
+
+    def __init__(self, playerRate=PLAYER_INPUT, spectatorRate=SPECTATOR_INPUT, policy=FLOOD_POLICY):
+        self.playerRate = playerRate
+        self.spectatorRate = spectatorRate
+        self.policy = policy
+        self.throttled = 0
+        self.dropped = 0
+        self.disconnected = 0
+
+    def allowance(self, player: Player):
+        if player.seated:
+            return self.playerRate
+        return self.spectatorRate
+
+    def over_bytes(self, player: Player, received, now):
+        # seconds the connection should go unread for
+        rate, _ = self.allowance(player)
+        return player.bytesIn.spend(received, rate, rate * INPUT_BURST, now)
+
+    def allow_message(self, player: Player, now):
+        _, rate = self.allowance(player)
+        if player.messagesIn.take(1, rate, rate * INPUT_BURST, now):
+            return True
+        self.dropped += 1
+        return False
+
+
+class SendLimits():
+    '''
+    How much output may wait for a client and what happens past that, with
+    counts of each action taken. A client whose backlog stays over limit
+    for timeout seconds is disconnected. Before that, what a spectator is
+    sent depends on the policy:
+
+    skip: game updates are skipped while it is over the limit. Once its
+    backlog clears it is sent the game as it stands and gets updates again
+    snapshot: the same, except it is only sent the game as it stands from
+    then on, whenever its backlog has cleared, until it is seated
+    disconnect: nothing is skipped
+    '''
+    POLICIES = ('skip', 'snapshot', 'disconnect')
+
+    def __init__(self, limit=SEND_LIMIT, policy=SLOW_POLICY, timeout=SLOW_TIMEOUT):
+        self.limit = limit
+        self.policy = policy
+        self.timeout = timeout
+        self.skipped = 0
+        self.snapshots = 0
+        self.disconnected = 0
+
+
+def report_stats(limits: SendLimits, inputs: InputLimits, queue, callLater, interval):
+    with gameLock:
+        waiting, matched = len(queue), queue.matched
+        p50, p90, p99 = queue.percentiles((50, 90, 99))
+    print('skipped {} snapshots {} disconnected {} | throttled {} dropped {} disconnected {} | '
+          'waiting {} seated {} wait p50 {:.1f}s p90 {:.1f}s p99 {:.1f}s'.format(
+              limits.skipped, limits.snapshots, limits.disconnected,
+              inputs.throttled, inputs.dropped, inputs.disconnected,
+              waiting, matched, p50, p90, p99), flush=True)
+    callLater(interval, report_stats, limits, inputs, queue, callLater, interval)
+
+
+class Input():
+    '''
+    An event for the game. Moves carry the decoded message, the sender's
+    idnum and generation and when it was decoded, expiries carry the turn
+    number in msg
+    '''
+    MOVE = 0
+    ROSTER = 1
+    EXPIRED = 2
+
+    __slots__ = ('kind', 'received', 'idnum', 'generation', 'msg')
+
+    def __init__(self, kind, player=None, msg=None):
+        self.kind = kind
+        self.received = time.monotonic()
+        self.idnum = player.idnum if player else None
+        self.generation = player.generation if player else None
+        self.msg = msg
+
+
+class IdsExhausted(Exception):
+    pass
+
+
+class IdAllocator():
+    '''
+    Hands out idnums below tiles.IDNUM_LIMIT in O(1). Released ids queue up
+    on a free list and each reuse bumps that id's generation, so an idnum
+    and generation together name one connection for the life of the server
+    '''
+    def __init__(self, limit=tiles.IDNUM_LIMIT):
+        self.limit = limit
+        self.fresh = 0
+        self.free = deque()
+        self.generations = [0] * limit
+        self.lock = Lock()
+
+    def allocate(self):
+        with self.lock:
+            if self.free:
+                idnum = self.free.popleft()
+            elif self.fresh < self.limit:
+                idnum = self.fresh
+                self.fresh += 1
+            else:
+                raise IdsExhausted('all {} idnums are in use'.format(self.limit))
+            return idnum, self.generations[idnum]
+
+    def release(self, idnum):
+        with self.lock:
+            self.generations[idnum] += 1
+            self.free.append(idnum)
+
+
+class RosterChunk():
+    __slots__ = ('joined', 'packed')
+
+    def __init__(self):
+        self.joined = {}
+        self.packed = None
+
+
+class Roster():
+    '''
+    A PLAYER_JOINED for everyone announced, each packed once. They are kept
+    in chunks so a change only repacks its own chunk and a joiner is handed
+    the chunks as they stand, whatever the number of players.
+
+    Joins and leaves wait in pending until they are announced together, a
+    player who joins and leaves in the same window is never announced.
+    Subscribed relays hear every announcement without being in it
+    '''
+    def __init__(self, window=0):
+        self.subscribers = []
+        self.chunks = []
+        self.where = {}
+        self.pending = {}
+        self.window = window
+        self.callLater = None
+        self.armed = False
+
+    def batch(self, window, callLater):
+        # callLater(delay, callback, *args) arms the announcement
+        self.window = window
+        self.callLater = callLater
+
+    def join(self, player: Player):
+        left, _ = self.pending.get(player.idnum, (None, None))
+        self.pending[player.idnum] = (left, tiles.MessagePlayerJoined(
+            player.getName(), player.idnum))
+
+    def leave(self, idnum):
+        left, joined = self.pending.get(idnum, (None, None))
+        if joined is None:
+            self.pending[idnum] = (tiles.MessagePlayerLeft(idnum), None)
+        elif left is None:
+            del self.pending[idnum]
+        else:
+            # left, then the idnum was reused by someone who left too
+            self.pending[idnum] = (left, None)
+
+    def commit(self):
+        '''
+        The pending changes in announcement order, folded into the roster
+        '''
+        changes = []
+        for idnum, (left, joined) in self.pending.items():
+            if left is not None:
+                self.remove(idnum)
+                changes.append(left)
+            if joined is not None:
+                self.add(joined)
+                changes.append(joined)
+        self.pending = {}
+        self.armed = False
+        return changes
+
+    def add(self, joined: tiles.MessagePlayerJoined, packed=None):
+        # packed is the message as received, when it was not made here
+        if not self.chunks or len(self.chunks[-1].joined) >= ROSTER_CHUNK:
+            self.chunks.append(RosterChunk())
+        chunk = self.chunks[-1]
+        chunk.joined[joined.idnum] = joined.pack() if packed is None else packed
+        chunk.packed = None
+        self.where[joined.idnum] = chunk
+
+    def remove(self, idnum):
+        chunk = self.where.pop(idnum, None)
+        if chunk is None:
+            return
+        del chunk.joined[idnum]
+        chunk.packed = None
+        if not chunk.joined:
+            self.chunks.remove(chunk)
+
+    def parts(self):
+        for chunk in self.chunks:
+            if chunk.packed is None:
+                chunk.packed = b''.join(chunk.joined.values())
+        return [chunk.packed for chunk in self.chunks]
+
+
+class Snapshot():
+    '''
+    The game so far compacted to the fewest messages that rebuild it: the
+    seating order, one PLACE_TILE per square, one MOVE_TOKEN per token, the
+    eliminations and whose turn it is. Packed into one buffer that every
+    joiner shares until the next change
+    '''
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self.started = None
+        self.seating = {}
+        self.tiles = {}
+        self.tokens = {}
+        self.eliminated = {}
+        self.current = None
+        self.cache = None
+
+    def extend(self, recorded):
+        for msg, packed in recorded:
+            if isinstance(msg, tiles.MessageGameStart):
+                self.clear()
+                self.started = packed
+            elif isinstance(msg, tiles.MessagePlayerTurn):
+                self.seating.setdefault(msg.idnum, packed)
+                self.current = packed
+            elif isinstance(msg, tiles.MessagePlaceTile):
+                self.tiles[msg.x, msg.y] = packed
+            elif isinstance(msg, tiles.MessageMoveToken):
+                self.tokens[msg.idnum] = packed
+            elif isinstance(msg, tiles.MessagePlayerEliminated):
+                self.eliminated[msg.idnum] = packed
+        self.cache = None
+
+    def depart(self, idnum):
+        # joiners never hear of a player who left, so drop their seat. their
+        # tiles and token stay on the board
+        if self.seating.pop(idnum, None) is not None:
+            self.eliminated.pop(idnum, None)
+            self.cache = None
+
+    def packed(self):
+        if self.cache is None:
+            parts = []
+            if self.started is not None:
+                parts.append(self.started)
+            parts.extend(self.seating.values())
+            parts.extend(self.tiles.values())
+            parts.extend(self.tokens.values())
+            parts.extend(self.eliminated.values())
+            if self.current is not None:
+                parts.append(self.current)
+            self.cache = b''.join(parts)
+        return self.cache
+
+
+class Broadcast():
+    '''
+    Collects the messages of one turn, each packed once, and delivers them
+    to every client as a single shared frame. A player with messages of its
+    own gets one frame with them spliced in where they were added
+    '''
+    def __init__(self, snapshot: Snapshot = None):
+        self.snapshot = snapshot
+        self.parts = []
+        self.size = 0
+        self.recorded = []
+        self.private = {}
+
+    def add(self, msg, record=True):
+        packed = msg.pack()
+        self.parts.append(packed)
+        self.size += len(packed)
+        if record:
+            self.recorded.append((msg, packed))
+
+    def add_private(self, player: Player, packed):
+        _, spliced = self.private.setdefault(player.idnum, (player, []))
+        spliced.append((self.size, packed))
+
+    def deliver(self, lobby, spectators):
+        with gameLock:
+            self.deliver_locked(lobby, spectators)
+
+    def deliver_locked(self, lobby, spectators):
+        if self.snapshot is not None:
+            self.snapshot.extend(self.recorded)
+
+        # players in the game go first, spectators can wait
+        frame = b''.join(self.parts)
+        if frame:
+            for client in lobby[:]:
+                if client.idnum not in self.private:
+                    client.send(frame)
+            for client in list(spectators):
+                if client.idnum in self.private:
+                    continue
+                if self.snapshot is None:
+                    client.send(frame, deferred=True)
+                else:
+                    client.send_update(frame, self.snapshot)
+
+        for player, spliced in self.private.values():
+            pieces = []
+            start = 0
+            with memoryview(frame) as view:
+                for offset, packed in spliced:
+                    pieces.append(view[start:offset])
+                    pieces.append(packed)
+                    start = offset
+                pieces.append(view[start:])
+                player.send(b''.join(pieces))
+
+        self.parts = []
+        self.size = 0
+        self.recorded = []
+        self.private = {}
+
+
+def boradcastCurrentPlayer(frame: Broadcast, currentPlayer):
+    frame.add(tiles.MessagePlayerTurn(currentPlayer.idnum))
+
+
+def boradcastPlayerEliminated(frame: Broadcast, player):
+    frame.add(tiles.MessagePlayerEliminated(player.idnum))
+
+
+def boradcastGameStart(frame: Broadcast):
+    frame.add(tiles.MessageGameStart())
+
+
+def boradcastPositionUpdates(frame: Broadcast, updates):
     for update in updates:
-        updateStack.append(update.pack())
-        for client in clients:
-            client.connection.send(update.pack())
-
+        frame.add(update)
 
-def broadcastPlaceSuccessful(clients, msg):
-    global updateStack
-    updateStack.append(msg)
 
-    for client in clients:
-        client.connection.send(msg)
+def broadcastPlaceSuccessful(frame: Broadcast, msg):
+    frame.add(msg)
 
 
-def boradcastCountdown(clients):
-    msg = tiles.MessageCountdown().pack()
-    for client in clients:
-        client.connection.send(msg)
+def boradcastCountdown(frame: Broadcast):
+    frame.add(tiles.MessageCountdown(), record=False)
 
 
-def broadcastUpdates(lobby, queue, board, current):
+def broadcastUpdates(frame: Broadcast, room, queue, board, current):
+    lobby = room.lobby
     live_idnums = [client.idnum for client in lobby]
     positionupdates, eliminated = board.do_player_movement(live_idnums)
 
-    boradcastPositionUpdates(lobby + queue, positionupdates)
+    boradcastPositionUpdates(frame, positionupdates)
 
     # get eliminated clients
     eliminatedClients = [
@@ -96,75 +729,954 @@ def broadcastUpdates(lobby, queue, board, current):
     # change players turn
     lobby.append(lobby.pop(0))
 
-    # eliminated player exits game and returns to queue
+    # eliminated player exits game and returns to queue, still watching
     for client in eliminatedClients:
-        boradcastPlayerEliminated(lobby + queue, client)
-        queue.append(client)
+        boradcastPlayerEliminated(frame, client)
+        room.spectators[client.idnum] = client
         lobby.remove(client)
-
-
-def update_status(queue: list, lobby: list, server, updateStack: list):
+        client.seat(False)
+    queue.extend(eliminatedClients)
+
+
+class Room():
+    '''
+    A table running its own game. Players seated at it are its lobby, the
+    waiting clients following its game are its spectators, by idnum so
+    seating one is O(1)
+    '''
+    def __init__(self, number=0):
+        self.number = number
+        self.lobby = []
+        self.spectators = {}
+        self.snapshot = Snapshot()
+        self.inputs = SimpleQueue()
+        self.idle = False
+        self.playing = False
+
+    def wake(self):
+        self.idle = False
+        self.inputs.put_nowait(Input(Input.ROSTER))
+
+
+class Matchmaker():
+    '''
+    The waiting players, longest waiting first, in a heap so adding and
+    seating a player are O(log n). Players who started waiting together,
+    such as a lobby back from its game, are seated in random order, or in
+    the order they were added with the arrival tiebreak. A player who stops
+    waiting is only marked gone, and skipped once it comes up. The waits of
+    the last players seated are kept for percentiles
+    '''
+    TIEBREAKS = ('random', 'arrival')
+
+    def __init__(self, tiebreak=MATCH_TIEBREAK, samples=WAIT_SAMPLES):
+        self.tiebreak = tiebreak
+        self.heap = []
+        self.entries = {}
+        self.order = count()
+        self.waits = deque(maxlen=samples)
+        self.matched = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __iter__(self):
+        return (entry[-1] for entry in self.entries.values())
+
+    def append(self, player: Player):
+        self.extend([player])
+
+    def extend(self, players):
+        # everyone added together has waited as long
+        now = time.monotonic()
+        for player in players:
+            if player.idnum in self.entries:
+                self.remove(player)
+            tiebreak = random.random() if self.tiebreak == 'random' else 0
+            entry = [now, tiebreak, next(self.order), player]
+            self.entries[player.idnum] = entry
+            heapq.heappush(self.heap, entry)
+
+    def remove(self, player: Player):
+        self.entries.pop(player.idnum)[-1] = None
+
+        # rebuild once most of the heap is players long gone
+        if len(self.heap) > 2 * len(self.entries) + 64:
+            self.heap = [entry for entry in self.heap if entry[-1] is not None]
+            heapq.heapify(self.heap)
+
+    def first(self):
+        # the longest waiting player, or None
+        while self.heap and self.heap[0][-1] is None:
+            heapq.heappop(self.heap)
+        return self.heap[0][-1] if self.heap else None
+
+    def pop(self):
+        player = self.first()
+        stamp = heapq.heappop(self.heap)[0]
+        del self.entries[player.idnum]
+        self.waits.append(time.monotonic() - stamp)
+        self.matched += 1
+        return player
+
+    def percentiles(self, points):
+        # seconds waited by the last players seated, 0 before anyone is
+        waits = sorted(self.waits)
+        if not waits:
+            return [0.0 for _ in points]
+        return [waits[min(len(waits) - 1, len(waits) * point // 100)] for point in points]
+
+
+def seat_players(room: Room, queue: Matchmaker):
+    # the longest waiting take the room's empty seats
+    lobby = room.lobby
+    while queue and len(lobby) < tiles.PLAYER_LIMIT:
+        player = queue.pop()
+        del player.room.spectators[player.idnum]
+        player.room = room
+        player.shedding = False
+        player.seat(True)
+        lobby.append(player)
+
+
+def return_lobby(room: Room, queue: Matchmaker):
+    # players in the lobby go back to waiting, still watching
+    queue.extend(room.lobby)
+    for player in room.lobby:
+        room.spectators[player.idnum] = player
+        player.seat(False)
+    room.lobby.clear()
+
+
+def wake_rooms(queue: Matchmaker, idle: deque):
+    # fill idle rooms from the waiting players all at once, waking each
+    while idle and len(queue) >= 2:
+        room = idle.popleft()
+        seat_players(room, queue)
+        room.wake()
+
+
+class SharedBoards():
+    '''
+    Every room's board published to shared memory for readers on the same
+    machine, one slot per room. A slot's version is odd while its game thread
+    is writing it, so a reader keeps a copy only if the version was even and
+    unchanged on either side of it. Reading costs the server nothing
+    '''
+    def __init__(self, name, rooms):
+        self.memory = shared_memory.SharedMemory(name, create=True, size=BOARD_SLOT * rooms)
+        self.versions = [0] * rooms
+        self.unlinked = False
+        for number in range(rooms):
+            self.publish(number, tiles.Board(), [], [])
+
+    def remove_on_exit(self):
+        '''
+        Unlink the block when the server exits. SIGINT and SIGTERM unlink it
+        first and then stop the server as they otherwise would
+        '''
+        atexit.register(self.unlink)
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(signum, self.stopped)
+
+    def stopped(self, signum, frame):
+        self.unlink()
+        signal.signal(signum, signal.SIG_DFL)
+        os.kill(os.getpid(), signum)
+
+    def unlink(self):
+        # the mapping stays until exit, so a game thread mid-publish is safe
+        if not self.unlinked:
+            self.unlinked = True
+            self.memory.unlink()
+
+    def publish(self, number, board: tiles.Board, seats, lobby):
+        live = [player.idnum for player in lobby]
+        current = live[0] if len(live) > 1 else -1
+
+        values = [current, len(seats)]
+        for seat in range(tiles.PLAYER_LIMIT):
+            if seat < len(seats):
+                idnum = seats[seat]
+                x, y, position = board.playerpositions.get(idnum, (-1, -1, -1))
+                values.extend((idnum, idnum not in live, x, y, position))
+            else:
+                values.extend((-1, 0, -1, -1, -1))
+        for square in (board.tileids, board.tilerotations, board.tileplaceids):
+            values.extend(-1 if value is None else value for value in square)
+
+        offset = number * BOARD_SLOT
+        version = self.versions[number]
+        buffer = self.memory.buf
+        BOARD_VERSION.pack_into(buffer, offset, version + 1)
+        BOARD_STATE.pack_into(buffer, offset + BOARD_VERSION.size, *values)
+        BOARD_VERSION.pack_into(buffer, offset, version + 2)
+        self.versions[number] = version + 2
+
+
+def read_board(buffer, number):
+    '''
+    A consistent copy of a room's board from shared memory, as a dict. Never
+    waits on the server, only retries while the slot is being written
+    '''
+    offset = number * BOARD_SLOT
     while True:
-        activeSockets = [server]
-        for client in lobby + queue:
-            activeSockets.append(client.connection)
-
-        ready, _, _ = select.select(activeSockets, [], [])
-
-        for clientConnection in ready:
-            if clientConnection is server:
-                # handle new connection
-                connection, client_address = server.accept()
-
-                # find avaliable id numbers
-                usedID = {client.idnum for client in lobby + queue}
-                unusedID = set(range(tiles.IDNUM_LIMIT)) - usedID
-
-                # add player to queue
-                idnum = unusedID.pop()
-                newPlayer = Player(connection, client_address, idnum)
-
-                # send messages
-                connection.send(tiles.MessageWelcome(
-                    newPlayer.idnum).pack())
+        before, = BOARD_VERSION.unpack_from(buffer, offset)
+        if before & 1:
+            continue
+        state = bytes(buffer[offset + BOARD_VERSION.size:offset + BOARD_VERSION.size + BOARD_STATE.size])
+        after, = BOARD_VERSION.unpack_from(buffer, offset)
+        if before == after:
+            break
+
+    values = BOARD_STATE.unpack(state)
+    current, seated = values[:2]
+    seats = values[2:2 + 5 * tiles.PLAYER_LIMIT]
+    squares = values[2 + 5 * tiles.PLAYER_LIMIT:]
+    return {
+        'version': before,
+        'current': None if current < 0 else current,
+        'seats': [seats[seat * 5] for seat in range(seated)],
+        'eliminated': {seats[seat * 5] for seat in range(seated) if seats[seat * 5 + 1]},
+        'positions': {seats[seat * 5]: tuple(seats[seat * 5 + 2:seat * 5 + 5])
+                      for seat in range(seated) if seats[seat * 5 + 2] >= 0},
+        'tileids': [None if value < 0 else value for value in squares[:BOARD_SQUARES]],
+        'tilerotations': [None if value < 0 else value for value in squares[BOARD_SQUARES:2 * BOARD_SQUARES]],
+        'tileplaceids': [None if value < 0 else value for value in squares[2 * BOARD_SQUARES:]],
+    }
+
+
+class Session():
+    '''
+    A client that can resume after its connection drops. Everything sent
+    to it is kept until HISTORY_LIMIT bytes build up, counted from the
+    SESSION message. The timer ends the session if the client stays away
+    too long
+    '''
+    __slots__ = ('token', 'player', 'timer', 'log', 'sent', 'held')
+
+    def __init__(self, token, player: Player):
+        self.token = token
+        self.player = player
+        self.timer = None
+        self.restart()
+
+    def restart(self):
+        self.log = deque()
+        self.sent = 0
+        self.held = 0
+
+    def record(self, data):
+        self.log.append(data)
+        self.sent += len(data)
+        self.held += len(data)
+        while self.held - len(self.log[0]) >= HISTORY_LIMIT:
+            self.held -= len(self.log.popleft())
+
+    def replay(self, offset):
+        '''
+        Everything sent after the first offset bytes, or None if that is no
+        longer kept
+        '''
+        position = self.sent - self.held
+        if not position <= offset <= self.sent:
+            return None
+
+        parts = []
+        for data in self.log:
+            end = position + len(data)
+            if end > offset:
+                parts.append(memoryview(data)[max(offset - position, 0):])
+            position = end
+        return parts
+
+
+def catch_up(newPlayer: Player, roster: Roster, snapshot: Snapshot):
+    # welcome, everyone already here and the game so far
+    parts = [tiles.MessageWelcome(newPlayer.idnum).pack()]
+    parts.extend(roster.parts())
+    parts.append(snapshot.packed())
+    return parts
+
+
+def welcome_player(newPlayer: Player, queue: Matchmaker, rooms: list, roster: Roster, idle: deque):
+    with gameLock:
+        # gone before it could be welcomed, or welcomed already
+        if newPlayer.closed or newPlayer.welcomed:
+            return
+        newPlayer.welcomed = True
+
+        # newcomers follow the first room until they are seated, unless
+        # they asked to watch another before they were welcomed
+        room = rooms[0]
+        if newPlayer.watching is not None and 0 <= newPlayer.watching < len(rooms):
+            room = rooms[newPlayer.watching]
+
+        # everything it needs in one write
+        parts = catch_up(newPlayer, roster, room.snapshot)
+        if newPlayer.session is not None:
+            parts.append(extensions.MessageSession(newPlayer.session.token, 0).pack())
+        newPlayer.send_all(parts)
+
+        # its session is counted from here on
+        if newPlayer.session is not None:
+            newPlayer.session.restart()
+
+        newPlayer.room = room
+        room.spectators[newPlayer.idnum] = newPlayer
+
+        # relays hear everything but are never seated or announced
+        if newPlayer.relay:
+            roster.subscribers.append(newPlayer)
+            return
+        queue.append(newPlayer)
+
+        # make sure all clients know the new client
+        roster.join(newPlayer)
+        roster_changed(queue, rooms, roster)
+        wake_rooms(queue, idle)
+
+
+def remove_player(client: Player, queue: Matchmaker, rooms: list, roster: Roster):
+    with gameLock:
+        room = client.room
+        if room is not None:
+            if client.relay:
+                del room.spectators[client.idnum]
+                roster.subscribers.remove(client)
+                client.close()
+                return
+
+            frame = Broadcast(room.snapshot)
+
+            if client in room.lobby:
+                # player in game disconnected, or seated for the next one
+                room.lobby.remove(client)
+                if room.playing:
+                    boradcastPlayerEliminated(frame, client)
+            else:
+                # player in queue disconnected
+                queue.remove(client)
+                del room.spectators[client.idnum]
+
+            frame.deliver(room.lobby, room.spectators.values())
+            room.snapshot.depart(client.idnum)
+            roster.leave(client.idnum)
+            roster_changed(queue, rooms, roster)
+        client.close()
+
+
+def watch_room(client: Player, number, queue: Matchmaker, rooms: list):
+    '''
+    Move a waiting client over to following another room, sending it that
+    room's game so far. Asked before the client is welcomed, the room is
+    kept and it is welcomed into that room instead
+    '''
+    with gameLock:
+        if not client.welcomed:
+            client.watching = number
+            return
+        if client.room is None or client in client.room.lobby:
+            return
+        if not 0 <= number < len(rooms) or rooms[number] is client.room:
+            return
+
+        del client.room.spectators[client.idnum]
+        client.room = rooms[number]
+        client.room.spectators[client.idnum] = client
+        client.send(client.room.snapshot.packed())
+
+
+def subscribe_relay(client: Player, queue: Matchmaker, rooms: list, roster: Roster):
+    '''
+    Turn a client into a relay, taking it out of the queue and the roster
+    if it was welcomed as a player already
+    '''
+    with gameLock:
+        if client.relay or (client.room is not None and client in client.room.lobby):
+            return
+        client.relay = True
+        if not client.welcomed:
+            return
+
+        queue.remove(client)
+        roster.subscribers.append(client)
+        roster.leave(client.idnum)
+        roster_changed(queue, rooms, roster)
+
+
+def open_multicast(group, interface, ids, rooms: list, roster: Roster, callLater, interval):
+    '''
+    Start sending the first room's game and the roster changes to a
+    multicast group, as a relay that is always subscribed
+    '''
+    idnum, generation = ids.allocate()
+    feed = MulticastPlayer(group, idnum, generation, interface)
+    with gameLock:
+        feed.room = rooms[0]
+        rooms[0].spectators[feed.idnum] = feed
+        roster.subscribers.append(feed)
+    multicast_keyframes(feed, roster, callLater, interval)
+    return feed
+
+
+def multicast_keyframes(feed: MulticastPlayer, roster: Roster, callLater, interval):
+    # the welcome leads, so receivers know the idnum to hand out
+    with gameLock:
+        feed.keyframe(catch_up(feed, roster, feed.room.snapshot))
+    callLater(interval, multicast_keyframes, feed, roster, callLater, interval)
+
+
+def announce_roster(queue: Matchmaker, rooms: list, roster: Roster):
+    '''
+    Send every client the roster changes made since the last announcement,
+    all in one frame
+    '''
+    with gameLock:
+        frame = Broadcast()
+        for msg in roster.commit():
+            frame.add(msg, record=False)
+        seated = [player for room in rooms for player in room.lobby]
+        frame.deliver_locked(seated, list(queue) + roster.subscribers)
+
+
+def roster_changed(queue: Matchmaker, rooms: list, roster: Roster):
+    if not roster.window or roster.callLater is None:
+        announce_roster(queue, rooms, roster)
+    elif not roster.armed:
+        roster.armed = True
+        roster.callLater(roster.window, announce_roster, queue, rooms, roster)
+
+
+def onboard_thread(joining: SimpleQueue, queue: Matchmaker, rooms: list, roster: Roster, idle: deque):
+    '''
+    Welcomes accepted connections off the accept path, so a burst of joins
+    never holds up accepting or reading
+    '''
+    while True:
+        newPlayer = joining.get()
+        welcome_player(newPlayer, queue, rooms, roster, idle)
+
+
+class Registry():
+    '''
+    Connections keyed by file descriptor. Sockets are registered with the
+    selector once on accept and unregistered on disconnect, the owning player
+    rides along as the key data so dispatching a ready socket is O(1)
+    '''
+    def __init__(self, server, spectatorInterval=SPECTATOR_INTERVAL,
+                 spectatorPressure=SPECTATOR_PRESSURE, limits: SendLimits = None):
+        self.server = server
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(server, selectors.EVENT_READ)
+
+        # players with fresh output, handed over from any thread. spectators
+        # wait in their own queue so they never hold up the game
+        self.pending = deque()
+        self.deferred = deque()
+        self.thread = get_ident()
+
+        # under pressure spectator output is only flushed once per interval,
+        # letting their frames pile up into a single write
+        self.spectatorInterval = spectatorInterval
+        self.spectatorPressure = spectatorPressure
+        self.spectatorRound = 0
+        self.nextRound = 0
+
+        # clients over the send limit as (deadline, overSince, player), in
+        # the order they went over
+        self.limits = limits
+        self.slow = deque()
+
+        # throttled clients as (until, order, player), soonest first
+        self.throttles = []
+        self.order = count()
+
+        # lets other threads interrupt select when output is queued
+        self.wakeup, self.waker = socket.socketpair()
+        self.wakeup.setblocking(False)
+        self.waker.setblocking(False)
+        self.signalled = False
+        self.selector.register(self.wakeup, selectors.EVENT_READ, self)
+
+    def add(self, player: Player):
+        player.connection.setblocking(False)
+        player.registry = self
+        player.limits = self.limits
+        player.throttled = 0
+        self.selector.register(player.connection, selectors.EVENT_READ, player)
+
+    def remove(self, player: Player):
+        player.registry = None
+        self.watch(player, 0)
+
+    def add_service(self, fileobj, handler):
+        # anything else worth waking for, handled by calling handler()
+        self.selector.register(fileobj, selectors.EVENT_READ, handler)
+
+    def remove_service(self, fileobj):
+        self.selector.unregister(fileobj)
+
+    def watch(self, player: Player, events):
+        # a throttled client with nothing to write is not watched at all
+        try:
+            key = self.selector.get_key(player.connection)
+        except KeyError:
+            key = None
+
+        if not events:
+            if key is not None:
+                self.selector.unregister(player.connection)
+        elif key is None:
+            self.selector.register(player.connection, events, player)
+        elif key.events != events:
+            self.selector.modify(player.connection, events, player)
+
+    def throttle(self, player: Player, until):
+        # stop reading the client until it is back in credit
+        player.throttled = until
+        heapq.heappush(self.throttles, (until, next(self.order), player))
+        self.watch(player, selectors.EVENT_WRITE if player.outbox else 0)
+
+    def select(self):
+        return self.selector.select(self.timeout())
+
+    def timeout(self):
+        if self.pending or self.spectatorRound:
+            return 0
+        deadlines = []
+        if self.deferred:
+            deadlines.append(self.nextRound)
+        if self.slow:
+            deadlines.append(self.slow[0][0])
+        if self.throttles:
+            deadlines.append(self.throttles[0][0])
+        if not deadlines:
+            return None
+        return max(0, min(deadlines) - time.monotonic())
+
+    def over_limit(self, player: Player):
+        self.slow.append((player.overSince + self.limits.timeout, player.overSince, player))
+
+    def want_write(self, player: Player, deferred=False):
+        if player.writePending:
+            return
+        player.writePending = True
+        if deferred:
+            self.deferred.append(player)
+        else:
+            self.pending.append(player)
 
-                # make sure all clients know other clients
-                for player in lobby + queue:
-                    player.connection.send(tiles.MessagePlayerJoined(
-                        newPlayer.getName(), newPlayer.idnum).pack())
+        if get_ident() != self.thread and not self.signalled:
+            self.signalled = True
+            try:
+                self.waker.send(b'\0')
+            except BlockingIOError:
+                pass
+
+    def clear_wakeup(self):
+        # drain before clearing the flag. A wakeup sent in between would be
+        # drained with the flag left set, and no thread would signal again
+        try:
+            while self.wakeup.recv(RECV_SIZE):
+                pass
+        except BlockingIOError:
+            pass
+        self.signalled = False
+
+    def flush(self, player: Player):
+        '''
+        Write out a player's outbox, watching for writability only while
+        bytes are left over. Returns False if the connection has failed
+        '''
+        try:
+            drained = player.flush()
+        except OSError:
+            return False
+
+        events = 0 if player.throttled else selectors.EVENT_READ
+        if not drained:
+            events |= selectors.EVENT_WRITE
+        self.watch(player, events)
+        return True
+
+    def flush_pending(self):
+        '''
+        Flush every player that queued output since the last call, then a
+        batch of spectators. Returns the ones whose connection failed
+        '''
+        failed = []
+        while self.pending:
+            self.flush_next(self.pending, failed)
+
+        now = time.monotonic()
+        if not self.spectatorRound and self.deferred:
+            if len(self.deferred) < self.spectatorPressure or now >= self.nextRound:
+                self.spectatorRound = len(self.deferred)
+                self.nextRound = now + self.spectatorInterval
+
+        for _ in range(min(self.spectatorRound, SPECTATOR_BATCH)):
+            self.spectatorRound -= 1
+            self.flush_next(self.deferred, failed)
+
+        # clients still over the send limit since their deadline was set
+        while self.slow and self.slow[0][0] <= now:
+            _, overSince, player = self.slow.popleft()
+            if player.registry is self and player.overSince == overSince:
+                self.limits.disconnected += 1
+                failed.append(player)
+
+        # throttled clients back in credit are read again
+        while self.throttles and self.throttles[0][0] <= now:
+            until, _, player = heapq.heappop(self.throttles)
+            if player.registry is self and player.throttled == until:
+                player.throttled = 0
+                events = selectors.EVENT_READ
+                if player.outbox:
+                    events |= selectors.EVENT_WRITE
+                self.watch(player, events)
+        return failed
+
+    def flush_next(self, waiting: deque, failed: list):
+        player = waiting.popleft()
+        player.writePending = False
+        if player.registry is self and not self.flush(player):
+            failed.append(player)
+
+    def serve(self, accept, receive, drop, inputs: InputLimits = None):
+        '''
+        Service the sockets until a service handler returns True. Every new
+        connection is passed to accept, whatever a client sends to receive
+        along with the time it was read, and a client that hangs up or
+        cannot be written to is passed to drop
+        '''
+        # one receive buffer reused for every read
+        chunk = bytearray(RECV_SIZE)
+        view = memoryview(chunk)
+
+        while True:
+            for key, events in self.select():
+                client = key.data
+
+                if client is self:
+                    self.clear_wakeup()
+                elif client is None:
+                    # take every waiting connection
+                    for _ in range(ACCEPT_BATCH):
+                        try:
+                            connection, client_address = self.server.accept()
+                        except (BlockingIOError, InterruptedError):
+                            break
+                        accept(connection, client_address)
+                elif not isinstance(client, Player):
+                    if client():
+                        return
+                elif client.registry is not self:
+                    # dropped earlier in this batch
+                    continue
+                else:
+                    if events & selectors.EVENT_WRITE:
+                        if not self.flush(client):
+                            drop(client)
+                            continue
+
+                    if not events & selectors.EVENT_READ:
+                        continue
+
+                    try:
+                        received = client.connection.recv_into(view)
+                    except (BlockingIOError, InterruptedError):
+                        continue
+                    except ConnectionError:
+                        received = 0
+
+                    if not received:
+                        drop(client)
+                        continue
+
+                    # a client sending too much is read less often, or dropped
+                    now = time.monotonic()
+                    if inputs is not None:
+                        behind = inputs.over_bytes(client, received, now)
+                        if behind and inputs.policy == 'disconnect':
+                            inputs.disconnected += 1
+                            drop(client)
+                            continue
+                        if behind:
+                            inputs.throttled += 1
+                            self.throttle(client, now + behind)
+
+                    receive(client, view[:received], now)
+
+            # write out everything queued since the last wakeup, dropping a
+            # client queues more output for everyone else
+            failed = self.flush_pending()
+            while failed:
+                for client in failed:
+                    if client.registry is self:
+                        drop(client)
+                failed = self.flush_pending()
+
+
+class Timer():
+    __slots__ = ('deadline', 'order', 'callback', 'args', 'cancelled')
+
+    def __init__(self, deadline, order, callback, args):
+        self.deadline = deadline
+        self.order = order
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def __lt__(self, other):
+        return (self.deadline, self.order) < (other.deadline, other.order)
+
+
+class Scheduler():
+    '''
+    Owns every turn deadline on the monotonic clock. Timers sit in a heap so
+    arming and expiring cost O(log n), cancelled timers are skipped when they
+    surface and the heap is compacted once they make up half of it
+    '''
+    def __init__(self):
+        self.heap = []
+        self.order = count()
+        self.cancelled = 0
+        self.condition = Condition()
+        self.thread = Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def call_later(self, delay, callback, *args):
+        with self.condition:
+            timer = Timer(time.monotonic() + delay, next(self.order), callback, args)
+            heapq.heappush(self.heap, timer)
+
+            # only an earlier deadline changes how long the thread sleeps
+            if self.heap[0] is timer:
+                self.condition.notify()
+        return timer
+
+    def cancel(self, timer: Timer):
+        with self.condition:
+            if timer.cancelled:
+                return
+            timer.cancelled = True
+            self.cancelled += 1
+
+            if self.cancelled > len(self.heap) // 2:
+                self.heap = [timer for timer in self.heap if not timer.cancelled]
+                heapq.heapify(self.heap)
+                self.cancelled = 0
+
+    def run(self):
+        with self.condition:
+            while True:
+                if not self.heap:
+                    self.condition.wait()
+                    continue
+
+                timer = self.heap[0]
+                if timer.cancelled:
+                    heapq.heappop(self.heap)
+                    self.cancelled -= 1
+                    continue
+
+                delay = timer.deadline - time.monotonic()
+                if delay > 0:
+                    self.condition.wait(delay)
+                    continue
+
+                heapq.heappop(self.heap)
+                timer.cancelled = True
+
+                # callbacks may arm new timers
+                self.condition.release()
+                try:
+                    timer.callback(*timer.args)
+                finally:
+                    self.condition.acquire()
+
+
+def update_status(queue: Matchmaker, rooms: list, roster: Roster, server,
+                  ids: IdAllocator, joining: SimpleQueue,
+                  spectatorInterval=SPECTATOR_INTERVAL,
+                  spectatorPressure=SPECTATOR_PRESSURE,
+                  scheduler: Scheduler = None, resumeGrace=0, link=None, relayKey=0,
+                  limits: SendLimits = None, inputs: InputLimits = None):
+    registry = Registry(server, spectatorInterval, spectatorPressure, limits)
+
+    # sessions by resume token
+    sessions = {}
+
+    def leave(client):
+        room = client.room
+        remove_player(client, queue, rooms, roster)
+        ids.release(client.idnum)
+        if room is not None:
+            room.inputs.put(Input(Input.ROSTER))
+
+    def disconnect(client):
+        registry.remove(client)
+        session = client.session
+        if session is None or not client.welcomed:
+            leave(client)
+            return
+
+        # hold the seat in case the client comes back, its turns play out
+        # as random moves meanwhile
+        with gameLock:
+            client.detach()
+            session.timer = scheduler.call_later(resumeGrace, expire, session)
+
+    def expire(session):
+        with gameLock:
+            if sessions.get(session.token) is not session or not session.player.detached:
+                return
+            del sessions[session.token]
+        leave(session.player)
+
+    def resume(client, msg):
+        '''
+        Start a session for the connection, or hand it to the seat held for
+        the token. Returns the player now owning the connection
+        '''
+        with gameLock:
+            if client.session is not None:
+                return client
+
+            session = sessions.get(msg.token)
+            if session is None or client.welcomed:
+                token = 0
+                while not token or token in sessions:
+                    token = secrets.randbits(64)
+                client.session = sessions[token] = Session(token, client)
+
+                if client.welcomed:
+                    client.send(extensions.MessageSession(token, 0).pack())
+                    client.session.restart()
+                else:
+                    joining.put(client)
+                return client
+
+            # the seat takes over the connection, which was never welcomed.
+            # an old connection not yet seen to drop is superseded
+            seat = session.player
+            if seat.detached:
+                scheduler.cancel(session.timer)
+            else:
+                registry.remove(seat)
+                seat.detach()
+            registry.remove(client)
+            ids.release(client.idnum)
+            client.closed = True
+            seat.connection = client.connection
+            seat.buffer = client.buffer
+            seat.detached = False
+            registry.add(seat)
+
+            delta = session.replay(msg.offset)
+            if delta is not None:
+                resumed = extensions.MessageSession(session.token, msg.offset).pack()
+                seat.send_all([resumed] + delta, record=False)
+                return seat
+
+            # too far behind, so the whole state again with a fresh count
+            parts = catch_up(seat, roster, seat.room.snapshot)
+            if seat in seat.room.lobby:
+                for tileid in seat.hand:
+                    parts.append(tiles.MessageAddTileToHand(tileid).pack())
+            parts.append(extensions.MessageSession(session.token, 0).pack())
+            seat.send_all(parts)
+            session.restart()
+            return seat
+
+    def hand_over(idnum, target):
+        # pass a player still waiting alone here to the target worker
+        with gameLock:
+            client = queue.first()
+            if len(queue) != 1 or client.idnum != idnum:
+                return
+            if client.session is not None or client.registry is not registry:
+                return
+
+            registry.remove(client)
+
+            # what is still queued goes out first, then everyone it was told
+            # of here leaving, itself too. The target welcomes it afresh
+            parts = list(client.outbox)
+            parts.extend(tiles.MessagePlayerLeft(known).pack() for known in roster.where)
+            try:
+                client.connection.settimeout(HANDOVER_TIMEOUT)
+                client.connection.sendall(b''.join(parts))
+            except OSError:
+                leave(client)
+                return
+
+            link.hand_over(client, target)
+            room = client.room
+            remove_player(client, queue, rooms, roster)
+            room.inputs.put(Input(Input.ROSTER))
+
+    def coordinate():
+        try:
+            msg = link.events.recv()
+        except EOFError:
+            # a worker cannot go on without its coordinator
+            os._exit(1)
+
+        if msg[0] == 'handoff':
+            _, idnum, target = msg
+            hand_over(idnum, target)
+        elif msg[0] == 'player':
+            # a player handed over by another worker, which has told it
+            # everyone there left, so it is welcomed as a new connection
+            _, idnum, generation, address, buffered = msg
+            connection = socket.socket(fileno=recv_handle(link.events))
+            newPlayer = Player(connection, address, idnum, generation)
+            newPlayer.buffer.extend(buffered)
+            registry.add(newPlayer)
+            joining.put(newPlayer)
+
+    def accept(connection, client_address):
+        # turn the client away if every idnum is taken
+        try:
+            idnum, generation = ids.allocate()
+        except IdsExhausted:
+            connection.close()
+            return
+
+        # welcoming happens elsewhere
+        newPlayer = Player(connection, client_address, idnum, generation)
+        registry.add(newPlayer)
+        if resumeGrace:
+            # give a returning client the chance to ask for its seat
+            scheduler.call_later(HELLO_WINDOW, joining.put, newPlayer)
+        else:
+            joining.put(newPlayer)
 
-                    newPlayer.connection.send(tiles.MessagePlayerJoined(
-                        player.getName(), player.idnum).pack())
+    def receive(client, data, now):
+        for msg in client.feed(data):
+            if inputs is not None and not inputs.allow_message(client, now):
+                continue
+            if isinstance(msg, extensions.MessageResume):
+                if resumeGrace:
+                    client = resume(client, msg)
+            elif isinstance(msg, extensions.MessageWatch):
+                watch_room(client, msg.room, queue, rooms)
+            elif isinstance(msg, extensions.MessageSubscribe):
+                if relayKey and msg.key == relayKey:
+                    subscribe_relay(client, queue, rooms, roster)
+            elif valid_move(client, msg):
+                # only moves that can change the game are worth keeping
+                client.room.inputs.put(Input(Input.MOVE, client, msg))
 
-                # send cumilative updates to joining client
-                for msg in updateStack:
-                    newPlayer.connection.send(msg)
+    # the coordinator's messages are serviced with the sockets
+    if link is not None:
+        registry.add_service(link.events, coordinate)
 
-                queue.append(newPlayer)
-            else:
-                # store most recent message from client
-                message = clientConnection.recv(4096)
-
-                for client in lobby:
-                    if client.connection is clientConnection:
-                        client.message = message
-                        # player in game disconnected
-                        if not message:
-                            lobby.remove(client)
-                            boradcastPlayerEliminated(lobby + queue, client)
-                            boradcastPlayerLeave(lobby + queue, client)
-                            client.connection.close()
-                        break
-
-                for client in queue:
-                    if client.connection is clientConnection:
-                        client.message = message
-                        # player in queue disconnected
-                        if not message:
-                            queue.remove(client)
-                            boradcastPlayerLeave(lobby + queue, client)
-                            client.connection.close()
-                        break
+    registry.serve(accept, receive, disconnect, inputs)
 
 
 def random_move(currentPlayer: Player, board: tiles.Board):
@@ -220,119 +1732,956 @@ def random_move(currentPlayer: Player, board: tiles.Board):
     return chunk.pack()
 
 
-def game_thread(queue: list, lobby: list, updateStack: list):
-    while True:
-        # move players in lobby to queue and clear lobby
-        queue.extend(playerLobby)
-        lobby.clear()
-        updateStack.clear()
-
-        # stall unitl minimum player count reached
-        while (len(queue) < 2):
-            continue
-
-        boradcastCountdown(lobby + queue)
-        lobbySize = min([len(queue), tiles.PLAYER_LIMIT])
-
-        while len(lobby) < lobbySize:
-            player = random.choice(queue)
-            queue.remove(player)
-            lobby.append(player)
+def start_game(frame: Broadcast, queue: Matchmaker, room: Room):
+    boradcastCountdown(frame)
+    lobby = room.lobby
+
+    # the room may have been filled while idle, the rest of its seats now
+    seat_players(room, queue)
+    room.playing = True
+
+    # notify all players of start
+    boradcastGameStart(frame)
+
+    # give all players a random hand
+    for player in lobby:
+        boradcastCurrentPlayer(frame, player)
+        player.hand.clear()
+        for _ in range(tiles.HAND_SIZE):
+            tileid = tiles.get_random_tileid()
+            msg = tiles.MessageAddTileToHand(tileid).pack()
+            frame.add_private(player, msg)
+            player.hand.append(tileid)
+
+
+def play_move(frame: Broadcast, msg, currentPlayer: Player, board: tiles.Board, queue: Matchmaker, room: Room):
+    placingTile = isinstance(msg, tiles.MessagePlaceTile)
+    selectingToken = isinstance(msg, tiles.MessageMoveToken)
+
+    if placingTile:
+        # tile must come from the players hand
+        if msg.tileid not in currentPlayer.hand:
+            return
+
+        if board.set_tile(msg.x, msg.y, msg.tileid, msg.rotation, msg.idnum):
+            # notify client that placement was successful
+            broadcastPlaceSuccessful(frame, msg)
+
+            # pickup a new tile
+            tileid = tiles.get_random_tileid()
+            tilemsg = tiles.MessageAddTileToHand(tileid).pack()
+            frame.add_private(currentPlayer, tilemsg)
+
+            currentPlayer.hand.append(tileid)
+            currentPlayer.hand.remove(msg.tileid)
+
+            broadcastUpdates(frame, room, queue, board, currentPlayer)
+    elif selectingToken:
+        if not board.have_player_position(msg.idnum):
+            if board.set_player_start_position(msg.idnum, msg.x, msg.y, msg.position):
+                broadcastUpdates(frame, room, queue, board, currentPlayer)
+
+
+def valid_move(client: Player, msg):
+    '''
+    Whether a message could be a move in the client's game right now: its
+    turn, its own idnum, on the board, and a tile from its hand or a token
+    position. Nothing else is worth handing to the game thread
+    '''
+    room = client.room
+    if room is None or client not in room.lobby[:1]:
+        return False
+
+    if isinstance(msg, tiles.MessagePlaceTile):
+        return (msg.idnum == client.idnum and msg.tileid in client.hand and 0 <= msg.rotation < 4
+                and 0 <= msg.x < tiles.BOARD_WIDTH and 0 <= msg.y < tiles.BOARD_HEIGHT)
+    if isinstance(msg, tiles.MessageMoveToken):
+        return (msg.idnum == client.idnum and 0 <= msg.position < 8
+                and 0 <= msg.x < tiles.BOARD_WIDTH and 0 <= msg.y < tiles.BOARD_HEIGHT)
+    return False
+
+
+def turn_move(item: Input, currentPlayer: Player, board: tiles.Board, turn, turnStart):
+    '''
+    The move an event means for the current turn, or None if it is stale,
+    out of turn or only a wakeup
+    '''
+    if item.kind == Input.MOVE:
+        sender = (item.idnum, item.generation)
+        if sender == (currentPlayer.idnum, currentPlayer.generation) and item.received >= turnStart:
+            return item.msg
+    elif item.kind == Input.EXPIRED and item.msg == turn:
+        # replace player message with random move if overtime
+        chunk = random_move(currentPlayer, board)
+        msg, _ = tiles.read_message_from_bytearray(bytearray(chunk))
+        return msg
+    return None
+
+
+def open_room(room: Room, queue: Matchmaker, rooms: list, roster: Roster, idle: deque):
+    '''
+    Seat waiting players at the room and start its game, returning the
+    game's frame. With too few waiting the room goes idle and None is
+    returned
+    '''
+    with gameLock:
+        if len(room.lobby) + len(queue) < 2:
+            # anyone seated here since has to wait for another room
+            return_lobby(room, queue)
+            if not room.idle:
+                room.idle = True
+                idle.append(room)
+            return None
+        room.idle = False
+
+        # players about to be named in the game must be known to everyone
+        if roster.pending:
+            announce_roster(queue, rooms, roster)
+
+        frame = Broadcast(room.snapshot)
+        start_game(frame, queue, room)
+        return frame
+
+
+def close_room(room: Room, queue: Matchmaker, idle: deque):
+    # move players in lobby to queue, still watching, and clear lobby
+    with gameLock:
+        return_lobby(room, queue)
+        room.playing = False
+        room.snapshot.clear()
+        wake_rooms(queue, idle)
+
+
+def game_thread(room: Room, queue: Matchmaker, rooms: list, roster: Roster, idle: deque,
+                scheduler: Scheduler, boards: SharedBoards = None):
+    turns = count()
+    lobby = room.lobby
+    inputs = room.inputs
 
-        # notify all players of start
-        boradcastGameStart(lobby + queue)
+    while True:
+        close_room(room, queue, idle)
 
-        # give all players a random hand
-        for player in lobby:
-            boradcastCurrentPlayer(lobby + queue, player)
-            player.hand.clear()
-            for _ in range(tiles.HAND_SIZE):
-                tileid = tiles.get_random_tileid()
-                msg = tiles.MessageAddTileToHand(tileid).pack()
-                player.connection.send(msg)
-                player.hand.append(tileid)
+        # sleep until minimum player count reached
+        frame = open_room(room, queue, rooms, roster, idle)
+        while frame is None:
+            inputs.get()
+            frame = open_room(room, queue, rooms, roster, idle)
 
         # start main game loop
         board = tiles.Board()
+        seats = [player.idnum for player in lobby]
         currentPlayer = None
-        startTime = None
+        timer = None
+        if boards is not None:
+            boards.publish(room.number, board, seats, lobby)
 
         while len(lobby) > 1:
-            # start next turn
-            if currentPlayer is not lobby[0]:
-                currentPlayer = lobby[0]
-                boradcastCurrentPlayer(lobby + queue, currentPlayer)
-                startTime = time.time()
-
-            try:
-                chunk = currentPlayer.message
-                # replace player message with random move if overtime
-                if time.time() - startTime > TIMEOUT:
-                    chunk = random_move(currentPlayer, board)
-
-                # check if this message is populated
-                if not chunk:
-                    raise Exception("No Message or Disconnect")
+            # start next turn, sending the whole of the last one at once
+            with gameLock:
+                if len(lobby) < 2:
+                    break
+                if currentPlayer is not lobby[0]:
+                    currentPlayer = lobby[0]
+                    boradcastCurrentPlayer(frame, currentPlayer)
+                    frame.deliver(lobby, room.spectators.values())
+
+                    if timer is not None:
+                        scheduler.cancel(timer)
+                    turn = next(turns)
+                    turnStart = time.monotonic()
+                    timer = scheduler.call_later(
+                        TIMEOUT, inputs.put, Input(Input.EXPIRED, msg=turn))
+
+            # sleep until a move lands, the turn passes or time runs out
+            item = inputs.get()
+
+            with gameLock:
+                msg = turn_move(item, currentPlayer, board, turn, turnStart)
+                if msg is not None:
+                    play_move(frame, msg, currentPlayer, board, queue, room)
+                if boards is not None:
+                    boards.publish(room.number, board, seats, lobby)
+
+        if timer is not None:
+            scheduler.cancel(timer)
+
+        # final eliminations of the game
+        frame.deliver(lobby, room.spectators.values())
+        if boards is not None:
+            boards.publish(room.number, board, seats, lobby)
+
+
+async def handle_stream(reader, writer, queue: Matchmaker, rooms: list, roster: Roster, idle: deque,
+                        ids: IdAllocator, relayKey=0, limits: SendLimits = None,
+                        inputs: InputLimits = None):
+    # turn the client away if every idnum is taken
+    try:
+        idnum, generation = ids.allocate()
+    except IdsExhausted:
+        writer.close()
+        return
+
+    # add player to queue
+    newPlayer = StreamPlayer(writer, idnum, generation)
+    newPlayer.limits = limits
+    welcome_player(newPlayer, queue, rooms, roster, idle)
 
-                buffer = bytearray()
-                buffer.extend(chunk)
-                msg, consumed = tiles.read_message_from_bytearray(buffer)
-
-                # no idea how this exception could happen but included because
-                # original code had it
-                if not consumed:
-                    raise Exception("Message Not Read Into Buffer")
-
-                buffer = buffer[consumed:]
-
-                placingTile = isinstance(msg, tiles.MessagePlaceTile)
-                selectingToken = isinstance(msg, tiles.MessageMoveToken)
-
-                if placingTile:
-                    if board.set_tile(msg.x, msg.y, msg.tileid, msg.rotation, msg.idnum):
-                        index = board.tile_index(msg.x, msg.y)
-
-                        # notify client that placement was successful
-                        broadcastPlaceSuccessful(lobby + queue, msg.pack())
-
-                        # pickup a new tile
-                        tileid = tiles.get_random_tileid()
-                        tilemsg = tiles.MessageAddTileToHand(tileid).pack()
-                        currentPlayer.connection.send(tilemsg)
-
-                        currentPlayer.hand.append(tileid)
-                        currentPlayer.hand.remove(msg.tileid)
+    while True:
+        try:
+            chunk = await reader.read(RECV_SIZE)
+        except ConnectionError:
+            break
+
+        if not chunk:
+            break
+
+        # a client sending too much waits before its next read, or is dropped
+        now = time.monotonic()
+        behind = 0
+        if inputs is not None:
+            behind = inputs.over_bytes(newPlayer, len(chunk), now)
+            if behind and inputs.policy == 'disconnect':
+                inputs.disconnected += 1
+                break
+            if behind:
+                inputs.throttled += 1
 
-                        broadcastUpdates(lobby, queue, board, currentPlayer)
-                elif selectingToken:
-                    if not board.have_player_position(msg.idnum):
-                        if board.set_player_start_position(msg.idnum, msg.x, msg.y, msg.position):
-                            broadcastUpdates(lobby, queue, board, currentPlayer)
-            except:
+        for msg in newPlayer.feed(chunk):
+            if inputs is not None and not inputs.allow_message(newPlayer, now):
                 continue
+            if isinstance(msg, extensions.MessageWatch):
+                watch_room(newPlayer, msg.room, queue, rooms)
+            elif isinstance(msg, extensions.MessageSubscribe):
+                if relayKey and msg.key == relayKey:
+                    subscribe_relay(newPlayer, queue, rooms, roster)
+            elif valid_move(newPlayer, msg):
+                # only moves that can change the game are worth keeping
+                newPlayer.room.inputs.put_nowait(Input(Input.MOVE, newPlayer, msg))
+
+        if behind:
+            await asyncio.sleep(behind)
+
+    room = newPlayer.room
+    remove_player(newPlayer, queue, rooms, roster)
+    ids.release(newPlayer.idnum)
+    room.inputs.put_nowait(Input(Input.ROSTER))
+
+
+async def async_game(room: Room, queue: Matchmaker, rooms: list, roster: Roster, idle: deque,
+                     boards: SharedBoards = None):
+    loop = asyncio.get_running_loop()
+    turns = count()
+    lobby = room.lobby
+    inputs = room.inputs
 
+    while True:
+        close_room(room, queue, idle)
 
-# create a TCP/IP socket
-server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-
-# listen on all network interfaces
-server_address = ('', 30020)
-server.bind(server_address)
-
-server.listen(5)
+        # sleep until minimum player count reached
+        frame = open_room(room, queue, rooms, roster, idle)
+        while frame is None:
+            await inputs.get()
+            frame = open_room(room, queue, rooms, roster, idle)
 
-updateStack = []
-playerQueue = []
-playerLobby = []
+        # start main game loop
+        board = tiles.Board()
+        seats = [player.idnum for player in lobby]
+        if boards is not None:
+            boards.publish(room.number, board, seats, lobby)
 
-# constantly handle incomming connections
-statusThread = Thread(target=update_status, args=(playerQueue, playerLobby, server, updateStack))
-statusThread.start()
+        while len(lobby) > 1:
+            # start next turn
+            currentPlayer = lobby[0]
+            boradcastCurrentPlayer(frame, currentPlayer)
+            frame.deliver(lobby, room.spectators.values())
+            turn = next(turns)
+            turnStart = time.monotonic()
+            deadline = loop.time() + TIMEOUT
+
+            while len(lobby) > 1 and lobby[0] is currentPlayer:
+                try:
+                    item = await asyncio.wait_for(inputs.get(), deadline - loop.time())
+                except asyncio.TimeoutError:
+                    item = Input(Input.EXPIRED, msg=turn)
+
+                msg = turn_move(item, currentPlayer, board, turn, turnStart)
+                if msg is not None:
+                    play_move(frame, msg, currentPlayer, board, queue, room)
+                if boards is not None:
+                    boards.publish(room.number, board, seats, lobby)
+
+        # final eliminations of the game
+        frame.deliver(lobby, room.spectators.values())
+        if boards is not None:
+            boards.publish(room.number, board, seats, lobby)
+
+
+async def serve_asyncio(server_address, queue: Matchmaker, rooms: list, roster: Roster, ids: IdAllocator,
+                        backlog=BACKLOG, rosterWindow=ROSTER_WINDOW, relayKey=0,
+                        multicast=None, multicastInterface='0.0.0.0',
+                        keyframeInterval=KEYFRAME_INTERVAL, boards: SharedBoards = None,
+                        limits: SendLimits = None, inputs: InputLimits = None, statsInterval=0):
+    '''
+    Run accepting, reading, turn timing and broadcasting on one event loop
+    '''
+    idle = deque()
+    for room in rooms:
+        room.inputs = asyncio.Queue()
+    roster.batch(rosterWindow, asyncio.get_running_loop().call_later)
+
+    if multicast is not None:
+        open_multicast(multicast, multicastInterface, ids, rooms, roster,
+                       asyncio.get_running_loop().call_later, keyframeInterval)
+    if limits is not None and inputs is not None and statsInterval:
+        report_stats(limits, inputs, queue, asyncio.get_running_loop().call_later, statsInterval)
+
+    server = await asyncio.start_server(
+        lambda reader, writer: handle_stream(
+            reader, writer, queue, rooms, roster, idle, ids, relayKey, limits, inputs),
+        *server_address, backlog=backlog)
+
+    async with server:
+        await asyncio.gather(
+            server.serve_forever(),
+            *[async_game(room, queue, rooms, roster, idle, boards) for room in rooms])
+
+
+class WorkerLink():
+    '''
+    A worker's two connections to the coordinator. Requests go out on one,
+    a lock keeping each request and its reply together, and the
+    coordinator's own messages arrive on the other. Stands in for the
+    IdAllocator so idnums stay unique across workers
+    '''
+    def __init__(self, address, index):
+        self.index = index
+        self.requests = Client(address, family='AF_UNIX')
+        self.requests.send(('requests', index))
+        self.events = Client(address, family='AF_UNIX')
+        self.events.send(('events', index))
+        self.lock = Lock()
+        self.alone = None
+
+    def request(self, *msg):
+        with self.lock:
+            self.requests.send(msg)
+
+    def allocate(self):
+        with self.lock:
+            self.requests.send(('allocate',))
+            allocated = self.requests.recv()
+        if allocated is None:
+            raise IdsExhausted()
+        return allocated
+
+    def release(self, idnum):
+        self.request('release', idnum)
+
+    def hand_over(self, player: Player, target):
+        # the coordinator passes the connection itself on to the target
+        meta = (player.idnum, player.generation, (player.host, player.port), bytes(player.buffer))
+        with self.lock:
+            self.requests.send(('player', target, meta))
+            send_handle(self.requests, player.connection.fileno(), 0)
+
+
+class Coordinator():
+    '''
+    Runs in the parent process once the workers are forked. Hands out
+    idnums and pairs up players waiting alone on different workers, moving
+    one of them to the other worker
+    '''
+    def __init__(self, listener, workers):
+        self.ids = IdAllocator()
+        self.requests = {}
+        self.events = {}
+        self.lonely = {}
+
+        # every worker connects twice
+        while len(self.requests) + len(self.events) < 2 * workers:
+            connection = listener.accept()
+            kind, index = connection.recv()
+            if kind == 'requests':
+                self.requests[connection] = index
+            else:
+                self.events[index] = connection
+
+    def run(self):
+        while self.requests:
+            for connection in wait(list(self.requests)):
+                index = self.requests[connection]
+                try:
+                    msg = connection.recv()
+                except EOFError:
+                    del self.requests[connection]
+                    self.lonely.pop(index, None)
+                    continue
+
+                if msg[0] == 'allocate':
+                    try:
+                        connection.send(self.ids.allocate())
+                    except IdsExhausted:
+                        connection.send(None)
+                elif msg[0] == 'release':
+                    self.ids.release(msg[1])
+                elif msg[0] == 'lonely':
+                    self.lonely[index] = msg[1]
+                    self.pair(index)
+                elif msg[0] == 'settled':
+                    self.lonely.pop(index, None)
+                elif msg[0] == 'player':
+                    _, target, meta = msg
+                    handle = recv_handle(connection)
+                    try:
+                        self.events[target].send(('player',) + meta)
+                        send_handle(self.events[target], handle, 0)
+                    except OSError:
+                        pass
+                    finally:
+                        os.close(handle)
+
+    def pair(self, index):
+        # the newly lonely player moves to a worker that was waiting already
+        for other in self.lonely:
+            if other != index:
+                idnum = self.lonely.pop(index)
+                self.events[index].send(('handoff', idnum, other))
+                return
+
+
+def report_waiting(queue: Matchmaker, link: WorkerLink, scheduler: Scheduler):
+    '''
+    Tell the coordinator when one player is waiting alone on this worker,
+    so it can be paired with one waiting alone on another
+    '''
+    with gameLock:
+        alone = None
+        if len(queue) == 1 and queue.first().session is None:
+            alone = queue.first().idnum
+
+    if alone != link.alone:
+        link.alone = alone
+        if alone is None:
+            link.request('settled')
+        else:
+            link.request('lonely', alone)
+    scheduler.call_later(LONELY_CHECK, report_waiting, queue, link, scheduler)
+
+
+def serve_threaded(args, link: WorkerLink = None):
+    # listen on all network interfaces
+    server_address = ('', args.port)
+    rooms = [Room(number) for number in range(max(args.rooms, 1))]
+
+    # workers take their idnums from the coordinator
+    ids = playerIds if link is None else link
+
+    # create a TCP/IP socket, shared between workers if there are any
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    if link is not None:
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    server.bind(server_address)
+
+    server.listen(args.backlog)
+    server.setblocking(False)
+
+    # fires turn deadlines
+    scheduler = Scheduler()
+    scheduler.start()
+
+    # accepted connections waiting for their welcome
+    joining = SimpleQueue()
+
+    # joins and leaves are announced in batches
+    playerRoster.batch(args.roster_window, scheduler.call_later)
+
+    if args.multicast:
+        host, _, port = args.multicast.rpartition(':')
+        open_multicast((host, int(port)), args.multicast_interface, ids, rooms, playerRoster,
+                       scheduler.call_later, args.keyframe_interval)
+
+    if link is not None:
+        report_waiting(playerQueue, link, scheduler)
+
+    # boards for readers on this machine
+    boards = None
+    if args.shared_board:
+        boards = SharedBoards(args.shared_board, len(rooms))
+        boards.remove_on_exit()
+
+    # how much output a slow client and input a flooding one may cost
+    limits = SendLimits(args.send_limit, args.slow_policy, args.slow_timeout)
+    inputs = InputLimits(tuple(args.player_input), tuple(args.spectator_input), args.flood_policy)
+    if args.stats_interval:
+        report_stats(limits, inputs, playerQueue, scheduler.call_later, args.stats_interval)
+
+    # constantly handle incomming connections
+    statusThread = Thread(target=update_status, args=(playerQueue, rooms, playerRoster, server, ids,
+                                                      joining, args.spectator_interval, args.spectator_pressure,
+                                                      scheduler, args.resume_grace, link, args.relay_key,
+                                                      limits, inputs))
+    statusThread.start()
+
+    # welcome new connections
+    onboardThread = Thread(target=onboard_thread, args=(joining, playerQueue, rooms, playerRoster, idleRooms))
+    onboardThread.start()
+
+    # start a game in every room, each room's moves, leaves and expired
+    # turns arrive in order on its inputs
+    gameThreads = []
+    for room in rooms:
+        gameThread = Thread(target=game_thread, args=(room, playerQueue, rooms, playerRoster, idleRooms,
+                                                      scheduler, boards))
+        gameThread.start()
+        gameThreads.append(gameThread)
+
+    # the threads run forever
+    statusThread.join()
+    onboardThread.join()
+    for gameThread in gameThreads:
+        gameThread.join()
+
+
+def serve_workers(args):
+    '''
+    Fork the workers, each serving the port through SO_REUSEPORT with its
+    own rooms, then coordinate them until they are gone
+    '''
+    address = os.path.join(tempfile.mkdtemp(), 'coordinator')
+    listener = Listener(address, family='AF_UNIX')
+
+    workers = []
+    for index in range(args.workers):
+        pid = os.fork()
+        if pid == 0:
+            try:
+                serve_threaded(args, WorkerLink(address, index))
+            finally:
+                os._exit(1)
+        workers.append(pid)
+
+    # stopping the coordinator stops the workers with it
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit())
+    try:
+        Coordinator(listener, args.workers).run()
+    finally:
+        for pid in workers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        listener.close()
+        os.rmdir(os.path.dirname(address))
+
+
+class RemotePlayer(Player):
+    '''
+    A player as an engine process sees it. Output goes through the outlet to
+    the gateway, which owns the socket
+    '''
+    def __init__(self, outlet, address, idnum, generation=0):
+        super().__init__(None, address, idnum, generation)
+        self.outlet = outlet
+
+    def send(self, data, deferred=False):
+        self.outlet.add(self.idnum, data, deferred)
+
+    def send_all(self, parts, deferred=False, record=True):
+        self.outlet.add(self.idnum, b''.join(parts), deferred)
+
+    def seat(self, seated):
+        # the gateway reads the socket and matches engines, so it is told
+        self.seated = seated
+        self.outlet.notify(self.idnum, 'seated' if seated else 'waiting')
+
+    def close(self):
+        self.closed = True
+
+
+class Outlet():
+    '''
+    An engine's output on its way to the gateway, written by its own thread
+    so the game never waits on the pipe. A frame sent to many players
+    crosses the pipe once with the idnums it is for. A notice about a player
+    goes in a frame of its own with no data
+    '''
+    def __init__(self, connection):
+        self.connection = connection
+        self.pending = []
+        self.condition = Condition()
+        self.thread = Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def add(self, idnum, data, deferred=False):
+        with self.condition:
+            if not self.pending:
+                self.condition.notify()
+            self.pending.append((idnum, data, deferred))
+
+    def notify(self, idnum, notice):
+        self.add(idnum, None, notice)
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.pending:
+                    self.condition.wait()
+                pending, self.pending = self.pending, []
+
+            # frames go out in the order they were first sent, which keeps
+            # every player's own output in order
+            frames = {}
+            for idnum, data, deferred in pending:
+                # notices are kept apart so they arrive in order
+                key = (id(data), deferred) if data is not None else object()
+                if key not in frames:
+                    frames[key] = (data, deferred, [])
+                frames[key][2].append(idnum)
+            self.connection.send(list(frames.values()))
+
+
+def engine_main(connection, args):
+    '''
+    An engine process: rooms, roster and games for the players the gateway
+    assigns to it. Joins, moves and leaves arrive on the connection
+    '''
+    queue = Matchmaker(args.tiebreak)
+    rooms = [Room(number) for number in range(max(args.rooms, 1))]
+    roster = Roster()
+    idle = deque()
+    players = {}
+
+    outlet = Outlet(connection)
+    outlet.start()
+
+    scheduler = Scheduler()
+    scheduler.start()
+    roster.batch(args.roster_window, scheduler.call_later)
+
+    for room in rooms:
+        Thread(target=game_thread, args=(room, queue, rooms, roster, idle, scheduler),
+               daemon=True).start()
 
-# start game
-gameThread = Thread(target=game_thread, args=(playerQueue, playerLobby, updateStack))
-gameThread.start()
+    while True:
+        try:
+            msg = connection.recv()
+        except (EOFError, OSError):
+            # nothing left to play for without the gateway
+            return
+
+        if msg[0] == 'join':
+            _, idnum, generation, address = msg
+            newPlayer = RemotePlayer(outlet, address, idnum, generation)
+            players[idnum] = newPlayer
+            welcome_player(newPlayer, queue, rooms, roster, idle)
+        elif msg[0] == 'input':
+            _, idnum, packed = msg
+            player = players.get(idnum)
+            if player is None:
+                continue
 
-# infinite loop with threads running in background
-while True:
-    continue
+            # only moves that can change the game are worth keeping
+            for chunk in packed:
+                decoded, _ = tiles.read_message_from_bytearray(chunk)
+                if valid_move(player, decoded):
+                    player.room.inputs.put(Input(Input.MOVE, player, decoded))
+        elif msg[0] == 'leave':
+            player = players.pop(msg[1], None)
+            if player is not None:
+                room = player.room
+                remove_player(player, queue, rooms, roster)
+                if room is not None:
+                    room.inputs.put(Input(Input.ROSTER))
+        elif msg[0] == 'handoff':
+            # pass a player still waiting alone here to another engine. It is
+            # told everyone here left, itself too, and is welcomed there afresh
+            idnum = msg[1]
+            with gameLock:
+                player = players.get(idnum)
+                if player is None or len(queue) != 1 or queue.first() is not player:
+                    outlet.notify(idnum, 'kept')
+                    continue
+
+                player.send_all([tiles.MessagePlayerLeft(known).pack() for known in roster.where])
+                del players[idnum]
+                room = player.room
+                remove_player(player, queue, rooms, roster)
+                room.inputs.put(Input(Input.ROSTER))
+                outlet.notify(idnum, 'handed')
+
+
+class Engine():
+    '''
+    The gateway's handle on an engine process, the players it serves and
+    which of them are waiting for a seat
+    '''
+    def __init__(self, index, args):
+        self.index = index
+        self.args = args
+        self.players = set()
+        self.waiting = set()
+        self.start()
+
+    def start(self):
+        # spawned, not forked, so client sockets are never shared with it
+        context = multiprocessing.get_context('spawn')
+        self.connection, remote = context.Pipe()
+        self.process = context.Process(target=engine_main, args=(remote, self.args), daemon=True)
+        self.process.start()
+        remote.close()
+
+    def join(self, player: Player):
+        self.players.add(player.idnum)
+        self.waiting.add(player.idnum)
+        self.connection.send(('join', player.idnum, player.generation, (player.host, player.port)))
+
+
+def serve_gateway(args):
+    '''
+    Own every client connection and leave the games to engine processes.
+    Moves are framed here and forwarded, engine output is written back out
+    here, so no client can hold up a game
+    '''
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.bind(('', args.port))
+    server.listen(args.backlog)
+    server.setblocking(False)
+
+    limits = SendLimits(args.send_limit, args.slow_policy, args.slow_timeout)
+    inputs = InputLimits(tuple(args.player_input), tuple(args.spectator_input), args.flood_policy)
+    registry = Registry(server, args.spectator_interval, args.spectator_pressure, limits)
+    ids = IdAllocator()
+    players = {}
+    engines = [Engine(index, args) for index in range(args.engines)]
+
+    # players being handed between engines, by idnum, as (source, target)
+    handoffs = {}
+
+    def disconnect(client):
+        registry.remove(client)
+        client.close()
+        ids.release(client.idnum)
+        _, engine = players.pop(client.idnum)
+        engine.players.discard(client.idnum)
+        engine.waiting.discard(client.idnum)
+        engine.connection.send(('leave', client.idnum))
+        pair()
+
+    def listen(engine):
+        registry.add_service(engine.connection, lambda: deliver(engine))
+
+    def restart(engine):
+        # a new engine takes over, its players are welcomed there afresh
+        registry.remove_service(engine.connection)
+        engine.connection.close()
+        engine.process.join(0)
+        engine.start()
+        listen(engine)
+        for idnum in list(engine.players):
+            player, _ = players[idnum]
+            player.seated = False
+            engine.join(player)
+
+        # a handoff it was asked for will never be answered
+        for idnum, (source, _) in list(handoffs.items()):
+            if source is engine:
+                del handoffs[idnum]
+
+    def deliver(engine):
+        try:
+            frames = engine.connection.recv()
+        except (EOFError, OSError):
+            restart(engine)
+            return
+
+        # a frame without data carries a notice about its player instead
+        for data, deferred, idnums in frames:
+            for idnum in idnums:
+                if data is None:
+                    hear(engine, idnum, deferred)
+                    continue
+                player, owner = players.get(idnum, (None, None))
+                if owner is engine:
+                    player.send(data, deferred)
+        pair()
+
+    def hear(engine, idnum, notice):
+        player, owner = players.get(idnum, (None, None))
+        if notice in ('handed', 'kept'):
+            _, target = handoffs.pop(idnum, (None, None))
+            if notice == 'kept' or target is None or owner is not engine:
+                return
+
+            # told everyone there left, so the target welcomes it afresh
+            engine.players.discard(idnum)
+            engine.waiting.discard(idnum)
+            players[idnum] = (player, target)
+            target.join(player)
+        elif owner is engine:
+            player.seated = notice == 'seated'
+            if player.seated:
+                engine.waiting.discard(idnum)
+            else:
+                engine.waiting.add(idnum)
+
+    def company(candidates):
+        # the engine with the most waiting short of a game's worth, among
+        # those with anyone to play, or None
+        found = [engine for engine in candidates
+                 if engine.players and len(engine.waiting) < tiles.PLAYER_LIMIT]
+        return max(found, key=lambda engine: len(engine.waiting), default=None)
+
+    def route():
+        # a newcomer joins a group waiting for a seat or an engine with games
+        # going, and only goes to an empty engine when the others are full
+        engine = company(engines)
+        if engine is None:
+            engine = min(engines, key=lambda engine: len(engine.players))
+        return engine
+
+    def pair():
+        # a player alone on its engine moves to one where it has company, if
+        # its engine still finds it alone when asked
+        busy = {engine for handoff in handoffs.values() for engine in handoff}
+        for source in engines:
+            if len(source.players) != 1 or not source.waiting or source in busy:
+                continue
+            target = company(engine for engine in engines if engine is not source and engine not in busy)
+            if target is not None:
+                idnum = next(iter(source.waiting))
+                handoffs[idnum] = (source, target)
+                busy.update((source, target))
+                source.connection.send(('handoff', idnum))
+
+    def accept(connection, client_address):
+        # turn the client away if every idnum is taken
+        try:
+            idnum, generation = ids.allocate()
+        except IdsExhausted:
+            connection.close()
+            return
+
+        newPlayer = Player(connection, client_address, idnum, generation)
+        registry.add(newPlayer)
+        engine = route()
+        players[idnum] = (newPlayer, engine)
+        engine.join(newPlayer)
+        pair()
+
+    def receive(client, data, now):
+        # frame here, the engine only sees whole messages within the allowance
+        messages = [msg for msg in client.feed(data) if inputs.allow_message(client, now)]
+        if messages:
+            _, engine = players[client.idnum]
+            engine.connection.send(('input', client.idnum, [msg.pack() for msg in messages]))
+
+    for engine in engines:
+        listen(engine)
+    registry.serve(accept, receive, disconnect, inputs)
+
+
+playerRoster = Roster()
+playerQueue = Matchmaker()
+idleRooms = deque()
+playerIds = IdAllocator()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Tiles game server')
+    parser.add_argument('--port', type=int, default=PORT,
+                        help='port to listen on (default {})'.format(PORT))
+    parser.add_argument('--backlog', type=int, default=BACKLOG,
+                        help='connections the OS queues before they are accepted (default {})'.format(BACKLOG))
+    parser.add_argument('--rooms', type=int, default=1,
+                        help='games run side by side, each in its own room (default 1)')
+    parser.add_argument('--asyncio', action='store_true',
+                        help='serve all clients and the game from one asyncio event loop')
+    parser.add_argument('--spectator-interval', type=float, default=SPECTATOR_INTERVAL,
+                        help='seconds between spectator updates when the server is under pressure')
+    parser.add_argument('--spectator-pressure', type=int, default=SPECTATOR_PRESSURE,
+                        help='spectators waiting on output before their updates are coalesced')
+    parser.add_argument('--send-limit', type=int, default=SEND_LIMIT,
+                        help='bytes waiting for a client before it counts as slow (default {})'.format(SEND_LIMIT))
+    parser.add_argument('--slow-policy', choices=SendLimits.POLICIES, default=SLOW_POLICY,
+                        help='what a slow spectator is sent: skip updates until it catches up, '
+                             'only snapshots, or everything (default {})'.format(SLOW_POLICY))
+    parser.add_argument('--slow-timeout', type=float, default=SLOW_TIMEOUT,
+                        help='seconds a client may stay over the send limit before it is dropped '
+                             '(default {})'.format(SLOW_TIMEOUT))
+    parser.add_argument('--player-input', type=float, nargs=2, default=PLAYER_INPUT,
+                        metavar=('BYTES', 'MESSAGES'),
+                        help='what a player in a game may send a second (default {} {})'.format(*PLAYER_INPUT))
+    parser.add_argument('--spectator-input', type=float, nargs=2, default=SPECTATOR_INPUT,
+                        metavar=('BYTES', 'MESSAGES'),
+                        help='what anyone else may send a second (default {} {})'.format(*SPECTATOR_INPUT))
+    parser.add_argument('--flood-policy', choices=InputLimits.POLICIES, default=FLOOD_POLICY,
+                        help='what happens to a connection sending more than that: its reads are '
+                             'throttled, or it is disconnected (default {})'.format(FLOOD_POLICY))
+    parser.add_argument('--stats-interval', type=float, default=0,
+                        help='print the slow client and flood counters and the wait percentiles '
+                             'every so many seconds (default 0, never)')
+    parser.add_argument('--tiebreak', choices=Matchmaker.TIEBREAKS, default=MATCH_TIEBREAK,
+                        help='order players who started waiting at the same time are seated in '
+                             '(default {})'.format(MATCH_TIEBREAK))
+    parser.add_argument('--resume-grace', type=float, default=0,
+                        help='seconds a dropped client keeps its seat and may resume its session, '
+                             'threaded engine only (default 0, no sessions)')
+    parser.add_argument('--roster-window', type=float, default=ROSTER_WINDOW,
+                        help='seconds joins and leaves are collected into one announcement (default {})'.format(ROSTER_WINDOW))
+    parser.add_argument('--workers', type=int, default=1,
+                        help='worker processes sharing the port through SO_REUSEPORT, '
+                             'threaded engine only (default 1)')
+    parser.add_argument('--relay-key', type=int, default=0,
+                        help='key a relay.py process subscribes with, threaded and asyncio engines only '
+                             '(default 0, no relays)')
+    parser.add_argument('--multicast', metavar='GROUP:PORT',
+                        help='also send the first room\'s game to a multicast group, '
+                             'for relay.py --multicast to serve')
+    parser.add_argument('--multicast-interface', default='0.0.0.0',
+                        help='address of the interface multicast is sent from (default any)')
+    parser.add_argument('--keyframe-interval', type=float, default=KEYFRAME_INTERVAL,
+                        help='seconds between full states sent to the multicast group '
+                             '(default {})'.format(KEYFRAME_INTERVAL))
+    parser.add_argument('--shared-board', metavar='NAME',
+                        help='publish every room\'s board to the shared memory block NAME, '
+                             'for board_reader.py')
+    parser.add_argument('--engines', type=int, default=0,
+                        help='game engine processes behind a gateway process that owns the connections '
+                             '(default 0, games run alongside the connections)')
+    args = parser.parse_args()
+    playerQueue.tiebreak = args.tiebreak
+
+    if args.multicast and (args.engines > 0 or args.workers > 1):
+        parser.error('--multicast needs a single process, without --workers or --engines')
+    if args.shared_board and (args.engines > 0 or args.workers > 1):
+        parser.error('--shared-board needs a single process, without --workers or --engines')
+    if min(*args.player_input, *args.spectator_input) <= 0:
+        parser.error('--player-input and --spectator-input need rates above 0')
+
+    if args.engines > 0:
+        serve_gateway(args)
+    elif args.workers > 1:
+        if args.asyncio or not hasattr(socket, 'SO_REUSEPORT') or not hasattr(os, 'fork'):
+            parser.error('--workers needs the threaded engine, fork and SO_REUSEPORT')
+        serve_workers(args)
+    elif args.asyncio:
+        # listen on all network interfaces
+        rooms = [Room(number) for number in range(max(args.rooms, 1))]
+        multicast = None
+        if args.multicast:
+            host, _, port = args.multicast.rpartition(':')
+            multicast = (host, int(port))
+        boards = None
+        if args.shared_board:
+            boards = SharedBoards(args.shared_board, len(rooms))
+            boards.remove_on_exit()
+        asyncio.run(serve_asyncio(('', args.port), playerQueue, rooms, playerRoster, playerIds,
+                                  args.backlog, args.roster_window, args.relay_key,
+                                  multicast, args.multicast_interface, args.keyframe_interval, boards,
+                                  SendLimits(args.send_limit, args.slow_policy, args.slow_timeout),
+                                  InputLimits(tuple(args.player_input), tuple(args.spectator_input),
+                                              args.flood_policy),
+                                  args.stats_interval))
+    else:
+        serve_threaded(args)